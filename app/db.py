@@ -14,19 +14,35 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import collections
+import concurrent.futures
 import datetime
 import hashlib
 import json
+import logging
 import sqlite3
+import time
 import urllib.parse
-from typing import Iterable
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, \
+    TypeVar
 
 from aiohttp import web
 
+from . import metrics
+
+_LOGGER = logging.getLogger("openvplan")
+
+T = TypeVar("T")
+
 sqlite3.register_converter("JSON", json.loads)
 sqlite3.register_adapter(dict, lambda d: json.dumps(d).encode("utf-8"))
 
-sqlite3.register_converter("SELECTION", lambda s: [t.strip() for t in s.decode("utf-8").split(",")])
+def parse_selection(s: str) -> List[str]:
+    return [t.strip() for t in s.split(",")]
+
+
+sqlite3.register_converter("SELECTION", lambda s: parse_selection(s.decode("utf-8")))
 sqlite3.register_adapter(list, lambda selection: ",".join(selection).encode("utf-8"))
 
 
@@ -34,28 +50,145 @@ def hash_endpoint(endpoint):
     return hashlib.blake2b(endpoint.encode("utf-8"), digest_size=3).hexdigest()
 
 
+class PushMessage(NamedTuple):
+    payload: str
+    endpoints: List[str]
+    # see https://datatracker.ietf.org/doc/html/rfc8030#section-5
+    topic: Optional[str] = None
+    urgency: Optional[str] = None
+    # time after which the message is not sent anymore
+    expires: Optional[datetime.datetime] = None
+
+
+class PushSubscriptionIndex:
+    """
+    Push subscriptions of one plan, indexed by the groups selected in them (selection tokens). A subscription is
+    relevant for an affected group if one of its tokens is a substring of the group's name, so finding them only
+    needs a lookup for every substring of the affected groups instead of checking all subscriptions.
+    """
+
+    def __init__(self):
+        # endpoint -> (subscription, selection), selection is None if all groups are selected
+        self._subscriptions: Dict[str, Tuple[dict, Optional[Tuple[str, ...]]]] = {}
+        self._by_token: Dict[str, Set[str]] = {}
+        self._all_groups: Set[str] = set()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def add(self, endpoint: str, subscription: dict, selection: Optional[List[str]]):
+        self.remove(endpoint)
+        selection = tuple(selection) if selection is not None else None
+        self._subscriptions[endpoint] = (subscription, selection)
+        if selection is None:
+            self._all_groups.add(endpoint)
+        else:
+            for token in selection:
+                self._by_token.setdefault(token, set()).add(endpoint)
+
+    def remove(self, endpoint: str):
+        if (entry := self._subscriptions.pop(endpoint, None)) is None:
+            return
+        selection = entry[1]
+        if selection is None:
+            self._all_groups.discard(endpoint)
+        else:
+            for token in selection:
+                endpoints = self._by_token.get(token)
+                if endpoints is not None:
+                    endpoints.discard(endpoint)
+                    if not endpoints:
+                        del self._by_token[token]
+
+    def match_tokens(self, groups: Iterable[str]) -> Set[str]:
+        """ Return all selection tokens that are a substring of one of groups. """
+        tokens = set()
+        for group in groups:
+            for start in range(len(group) + 1):
+                for end in range(start, len(group) + 1):
+                    if group[start:end] in self._by_token:
+                        tokens.add(group[start:end])
+        return tokens
+
+    def get(self, endpoint: str) -> Optional[dict]:
+        entry = self._subscriptions.get(endpoint)
+        return entry[0] if entry is not None else None
+
+    def iter_matching(self, tokens: Iterable[str]) -> Iterator[Tuple[str, dict, Optional[Tuple[str, ...]]]]:
+        """ Yield (endpoint, subscription, selection) for all subscriptions with one of tokens or no selection. """
+        endpoints = set(self._all_groups)
+        for token in tokens:
+            endpoints.update(self._by_token.get(token, ()))
+        for endpoint in endpoints:
+            yield (endpoint, *self._subscriptions[endpoint])
+
+
+class _Write(NamedTuple):
+    operation: str
+    func: Callable[[], Any]
+    future: asyncio.Future
+
+
 class SubstitutionPlanDB:
-    def __init__(self, filepath, **kwargs):
-        self._connection = sqlite3.connect(filepath, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
-                                           **kwargs)
+    """
+    All statements run in a dedicated thread which owns the connection, so that disk I/O doesn't block the event
+    loop. The database uses write-ahead logging with synchronous=NORMAL, so commits don't wait for an fsync. After a
+    power loss, the last transactions may be lost, but the database is never corrupted.
+
+    Writes are committed in groups: all writes requested within commit_delay seconds, or while the previous group is
+    committed, share one transaction. Each write runs in its own savepoint, so a failing write doesn't affect the
+    others. The methods writing to the database return after the write was committed.
+    """
+
+    # rows fetched at once when iterating over the result of a query
+    FETCH_SIZE = 500
+    # number of endpoints in one query of get_push_messages_for_endpoints(), below SQLite's limit of host parameters
+    ENDPOINTS_PER_QUERY = 500
+
+    def __init__(self, filepath, commit_delay: float = 0, **kwargs):
+        self._filepath = filepath
+        self._commit_delay = commit_delay
+        self._connect_kwargs = kwargs
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="db")
+        self._connection: Optional[sqlite3.Connection] = None
+        self._push_subscriptions: Dict[str, PushSubscriptionIndex] = {}
+        self._writes: List[_Write] = []
+        self._write_event = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def open(self):
+        await self._run("open", self._open)
+        self._writer = asyncio.create_task(self._write_groups())
+        async for row in self._iter("load_push_subscriptions",
+                                    "SELECT plan_id, endpoint, subscription, selection FROM push_subscriptions2"):
+            self.get_push_subscriptions(row["plan_id"]).add(row["endpoint"], row["subscription"], row["selection"])
+
+    def _open(self):
+        # transactions are controlled explicitly, see _commit_writes()
+        self._connection = sqlite3.connect(self._filepath,
+                                           detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                                           isolation_level=None, **self._connect_kwargs)
         self._connection.row_factory = sqlite3.Row
-        self._cursor = self._connection.cursor()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        cursor = self._connection.cursor()
 
-        self._cursor.execute("PRAGMA main.user_version;")
-        user_version = self._cursor.fetchone()["user_version"]
+        cursor.execute("PRAGMA main.user_version;")
+        user_version = cursor.fetchone()["user_version"]
         if user_version == 0:
-            self._cursor.execute("""
+            cursor.execute("""
             CREATE TABLE IF NOT EXISTS push_subscriptions2
             (plan_id TEXT, subscription JSON, selection SELECTION, is_active BOOLEAN, endpoint_hash TEXT,
              endpoint_origin TEXT, last_change TIMESTAMP, unique(plan_id, subscription))""")
         """if user_version <= 1:
-            self._cursor.execute("ALTER TABLE push_subscriptions2 ADD COLUMN dnt_enabled BOOLEAN")
+            cursor.execute("ALTER TABLE push_subscriptions2 ADD COLUMN dnt_enabled BOOLEAN")
         if user_version <= 2:
-            self._cursor.execute("ALTER TABLE push_subscriptions2 ADD COLUMN user_agent TEXT")
-            self._cursor.execute("PRAGMA main.user_version = 3;")"""
+            cursor.execute("ALTER TABLE push_subscriptions2 ADD COLUMN user_agent TEXT")
+            cursor.execute("PRAGMA main.user_version = 3;")"""
         if user_version <= 3:
             # remove columns dnt_enabled and user_agent
-            self._cursor.executescript("""
+            cursor.executescript("""
             CREATE TEMPORARY TABLE push_subscriptions_tmp(plan_id TEXT, subscription JSON, selection SELECTION,
                                                           is_active BOOLEAN, endpoint_hash TEXT, endpoint_origin TEXT,
                                                           last_change TIMESTAMP, unique(plan_id, subscription));
@@ -68,25 +201,25 @@ class SubstitutionPlanDB:
             INSERT INTO push_subscriptions2 SELECT plan_id, subscription, selection, is_active, endpoint_hash, 
                                                    endpoint_origin, last_change FROM push_subscriptions_tmp;
             DROP TABLE push_subscriptions_tmp;""")
-            self._cursor.execute("PRAGMA main.user_version = 4;")
+            cursor.execute("PRAGMA main.user_version = 4;")
         if user_version <= 4:
-            self._cursor.execute(
+            cursor.execute(
                 "CREATE TABLE IF NOT EXISTS last_substitution_version_id (plan_id TEXT unique, version_id JSON)")
-            self._cursor.execute("PRAGMA main.user_version = 5;")
+            cursor.execute("PRAGMA main.user_version = 5;")
         if user_version <= 5:
             # push_subscriptions2: remove is_active, remove endpoint_origin, remove endpoint_hash, add endpoint,
             #                      new primary key: (plan_id, endpoint)
-            self._cursor.execute("""
+            cursor.execute("""
             CREATE TEMPORARY TABLE push_subscriptions_tmp(plan_id TEXT, endpoint TEXT, subscription JSON,
                                                           selection SELECTION,
                                                           last_change TIMESTAMP, unique(plan_id, endpoint))""")
-            for row in self._cursor.execute("SELECT * FROM push_subscriptions2 WHERE is_active=1").fetchall():
+            for row in cursor.execute("SELECT * FROM push_subscriptions2 WHERE is_active=1").fetchall():
                 subscription = row["subscription"]
                 endpoint = subscription["endpoint"]
-                self._cursor.execute(
+                cursor.execute(
                     "REPLACE INTO push_subscriptions_tmp VALUES (?,?,?,?,?)",
                     (row["plan_id"], endpoint, row["subscription"], row["selection"], row["last_change"]))
-            self._cursor.executescript("""
+            cursor.executescript("""
             DROP TABLE push_subscriptions2;
             CREATE TABLE push_subscriptions2(plan_id TEXT, endpoint TEXT, subscription JSON,
                                              selection SELECTION, last_change TIMESTAMP, unique(plan_id, endpoint));
@@ -94,40 +227,275 @@ class SubstitutionPlanDB:
                                                    selection, last_change FROM push_subscriptions_tmp;
             DROP TABLE push_subscriptions_tmp;
             """)
-            self._cursor.execute("PRAGMA main.user_version = 6;")
+            cursor.execute("PRAGMA main.user_version = 6;")
+        if user_version <= 6:
+            cursor.execute("CREATE TABLE IF NOT EXISTS status_changes (plan_id TEXT, time TIMESTAMP)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS status_changes_plan_id ON status_changes (plan_id, time)")
+            cursor.execute("PRAGMA main.user_version = 7;")
+        if user_version <= 7:
+            # push messages waiting to be sent, see enqueue_push_messages()
+            cursor.executescript("""
+            CREATE TABLE IF NOT EXISTS push_payloads (id INTEGER PRIMARY KEY, plan_id TEXT, payload TEXT,
+                                                      created TIMESTAMP);
+            CREATE TABLE IF NOT EXISTS push_outbox (id INTEGER PRIMARY KEY, payload_id INTEGER, endpoint TEXT,
+                                                    attempts INTEGER, next_attempt TIMESTAMP);
+            CREATE INDEX IF NOT EXISTS push_outbox_next_attempt ON push_outbox (next_attempt);
+            CREATE INDEX IF NOT EXISTS push_outbox_payload_id ON push_outbox (payload_id);
+            CREATE TABLE IF NOT EXISTS push_dead_letters (plan_id TEXT, endpoint TEXT, payload TEXT, attempts INTEGER,
+                                                          error TEXT, time TIMESTAMP);
+            """)
+            cursor.execute("PRAGMA main.user_version = 8;")
+        if user_version <= 8:
+            cursor.execute("ALTER TABLE push_payloads ADD COLUMN topic TEXT")
+            cursor.execute("ALTER TABLE push_payloads ADD COLUMN urgency TEXT")
+            cursor.execute("ALTER TABLE push_payloads ADD COLUMN expires TIMESTAMP")
+            cursor.execute("PRAGMA main.user_version = 9;")
+        if user_version <= 9:
+            cursor.execute("CREATE INDEX IF NOT EXISTS push_outbox_endpoint ON push_outbox (endpoint)")
+            cursor.execute("PRAGMA main.user_version = 10;")
+
+    async def _run(self, operation: str, func: Callable[..., T], *args) -> T:
+        """ Run func in the database's thread and measure how long the caller has to wait for it. """
+        t1 = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            metrics.DB_OPERATION_DURATION.observe(time.perf_counter() - t1, operation=operation)
 
-        self._connection.commit()
+    def _execute(self, query: str, params: Iterable = ()) -> sqlite3.Cursor:
+        # Every statement gets its own cursor, so that statements don't interfere. sqlite3 caches prepared statements
+        # per connection, so they are only prepared once as long as the query strings don't change.
+        return self._connection.execute(query, params)
 
-    def commit(self):
-        self._connection.commit()
+    async def _iter(self, operation: str, query: str, params: Iterable = ()) -> AsyncIterator[sqlite3.Row]:
+        """ Iterate over the result of a query, fetching FETCH_SIZE rows at a time. """
+        cursor = await self._run(operation, self._execute, query, params)
+        try:
+            while rows := await self._run(operation, cursor.fetchmany, self.FETCH_SIZE):
+                for row in rows:
+                    yield row
+        finally:
+            await self._run(operation, cursor.close)
 
-    def close(self):
-        self._connection.close()
+    async def _write(self, operation: str, func: Callable[[], T]) -> T:
+        """ Run func in the next group of writes and return its result after the group was committed. """
+        if self._closing:
+            raise RuntimeError("database is closed")
+        t1 = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append(_Write(operation, func, future))
+        self._write_event.set()
+        try:
+            return await future
+        finally:
+            metrics.DB_OPERATION_DURATION.observe(time.perf_counter() - t1, operation=operation)
 
-    def set_substitutions_version_id(self, plan_id: str, version_id: str):
-        self._cursor.execute("REPLACE INTO last_substitution_version_id VALUES (?,?)", (plan_id, version_id))
-        self._connection.commit()
+    async def _write_groups(self):
+        while not self._closing or self._writes:
+            await self._write_event.wait()
+            if self._commit_delay:
+                # wait for more writes
+                await asyncio.sleep(self._commit_delay)
+            self._write_event.clear()
+            writes, self._writes = self._writes, []
+            if not writes:
+                continue
+            metrics.DB_WRITES_PER_COMMIT.observe(len(writes))
+            try:
+                results = await self._run("commit", self._commit_writes, writes)
+            except Exception as e:
+                # the commit failed, so all writes are lost
+                results = [e] * len(writes)
+                # noinspection PyBroadException
+                try:
+                    if self._connection.in_transaction:
+                        await self._run("rollback", self._execute, "ROLLBACK")
+                except Exception:
+                    _LOGGER.exception("Rolling back failed writes failed")
+            for write, result in zip(writes, results):
+                if write.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    write.future.set_exception(result)
+                else:
+                    write.future.set_result(result)
 
-    def get_substitutions_version_id(self, plan_id: str) -> str:
-        self._cursor.execute("SELECT version_id FROM last_substitution_version_id WHERE plan_id=?", (plan_id,))
-        row = self._cursor.fetchone()
+    def _commit_writes(self, writes: List[_Write]) -> List[Any]:
+        results = []
+        self._execute("BEGIN")
+        for write in writes:
+            self._execute("SAVEPOINT write")
+            try:
+                results.append(write.func())
+            except Exception as e:
+                self._execute("ROLLBACK TO write")
+                results.append(e)
+            self._execute("RELEASE write")
+        self._execute("COMMIT")
+        return results
+
+    async def close(self):
+        # commit the remaining writes
+        self._closing = True
+        self._write_event.set()
+        await self._writer
+        await self._run("close", self._connection.close)
+        self._executor.shutdown()
+
+    async def set_substitutions_version_id(self, plan_id: str, version_id: str,
+                                           push_messages: Iterable[PushMessage] = (), push_delay: float = 0):
+        """
+        push_messages are added to the outbox in the same transaction (see enqueue_push_messages()), so that they
+        are sent if and only if the new version id is stored.
+        """
+        def set_version_id():
+            self._execute("REPLACE INTO last_substitution_version_id VALUES (?,?)", (plan_id, version_id))
+            self._enqueue_push_messages(plan_id, push_messages, push_delay)
+        await self._write("set_substitutions_version_id", set_version_id)
+
+    async def get_substitutions_version_id(self, plan_id: str) -> str:
+        row = await self._run("get_substitutions_version_id", lambda: self._execute(
+            "SELECT version_id FROM last_substitution_version_id WHERE plan_id=?", (plan_id,)).fetchone())
         return row["version_id"] if row is not None else None
 
-    def add_push_subscription(self, app: web.Application, plan_id: str, subscription: dict, selection: str):
+    async def add_status_change(self, plan_id: str, time: datetime.datetime, keep_days: int):
+        def add():
+            self._execute("INSERT INTO status_changes VALUES (?,?)", (plan_id, time))
+            self._execute("DELETE FROM status_changes WHERE plan_id=? AND time<?",
+                          (plan_id, time - datetime.timedelta(days=keep_days)))
+        await self._write("add_status_change", add)
+
+    async def get_status_changes(self, plan_id: str) -> List[datetime.datetime]:
+        return [row["time"] async for row in self._iter(
+            "get_status_changes", "SELECT time FROM status_changes WHERE plan_id=? ORDER BY time", (plan_id,))]
+
+    async def add_push_subscription(self, app: web.Application, plan_id: str, subscription: dict, selection: str):
         selection = selection.upper()
         try:
             endpoint = subscription["endpoint"]
         except Exception:
             raise ValueError("Wrong subscription object '" + str(subscription) + "'")
-        self._cursor.execute("REPLACE INTO push_subscriptions2 VALUES (?,?,?,?,?)",
-                             (plan_id, endpoint, subscription, selection, datetime.datetime.now()))
+        now = datetime.datetime.now()
+        await self._write("add_push_subscription", lambda: self._execute(
+            "REPLACE INTO push_subscriptions2 VALUES (?,?,?,?,?)", (plan_id, endpoint, subscription, selection, now)))
+        self.get_push_subscriptions(plan_id).add(endpoint, subscription, parse_selection(selection))
         app["logger"].debug(f"Add push subscription {plan_id}-{hash_endpoint(endpoint)[:6]} "
                             f"(origin: {urllib.parse.urlparse(endpoint).netloc})")
 
-    def delete_push_subscription(self, app: web.Application, plan_id: str, endpoint: str):
-        self._cursor.execute("DELETE FROM push_subscriptions2 WHERE plan_id=? AND endpoint=?",
-                             (plan_id, endpoint))
+    async def delete_push_subscription(self, app: web.Application, plan_id: str, endpoint: str):
+        await self._write("delete_push_subscription", lambda: self._execute(
+            "DELETE FROM push_subscriptions2 WHERE plan_id=? AND endpoint=?", (plan_id, endpoint)))
+        self.get_push_subscriptions(plan_id).remove(endpoint)
         app["logger"].debug(f"Delete push subscription {plan_id}-{hash_endpoint(endpoint)[:6]}")
 
-    def iter_push_subscriptions(self, plan_id: str) -> Iterable[sqlite3.Row]:
-        return self._cursor.execute("SELECT * FROM push_subscriptions2 WHERE plan_id=?", (plan_id,))
+    async def enqueue_push_messages(self, plan_id: str, messages: Iterable[PushMessage], delay: float = 0):
+        """ Add push messages to the outbox, to be sent after delay seconds. """
+        await self._write("enqueue_push_messages", lambda: self._enqueue_push_messages(plan_id, messages, delay))
+
+    def _enqueue_push_messages(self, plan_id: str, messages: Iterable[PushMessage], delay: float):
+        now = datetime.datetime.now()
+        next_attempt = now + datetime.timedelta(seconds=delay)
+        for message in messages:
+            # the payload is only stored once, most subscriptions share it
+            payload_id = self._execute(
+                "INSERT INTO push_payloads (plan_id, payload, created, topic, urgency, expires) VALUES (?,?,?,?,?,?)",
+                (plan_id, message.payload, now, message.topic, message.urgency, message.expires)).lastrowid
+            self._connection.executemany(
+                "INSERT INTO push_outbox (payload_id, endpoint, attempts, next_attempt) VALUES (?,?,0,?)",
+                ((payload_id, endpoint, next_attempt) for endpoint in message.endpoints))
+
+    _PUSH_MESSAGES_QUERY = """
+        SELECT push_outbox.id, endpoint, attempts, plan_id, payload, created, topic, urgency, expires FROM push_outbox
+        JOIN push_payloads ON push_payloads.id=push_outbox.payload_id"""
+
+    async def get_due_push_messages(self, now: datetime.datetime, limit: int) -> List[sqlite3.Row]:
+        return await self._run("get_due_push_messages", lambda: self._execute(
+            self._PUSH_MESSAGES_QUERY + " WHERE next_attempt<=? ORDER BY next_attempt LIMIT ?", (now, limit)
+        ).fetchall())
+
+    async def get_push_messages_for_endpoints(self, endpoints: Iterable[str], now: datetime.datetime) \
+            -> List[sqlite3.Row]:
+        """
+        Return the messages in the outbox for endpoints which are due at now or have not been attempted yet, i.e. are
+        only waiting for the dedup window. Messages waiting for a retry aren't returned before they are due.
+        """
+        def get():
+            messages = []
+            for i in range(0, len(endpoints), self.ENDPOINTS_PER_QUERY):
+                chunk = endpoints[i:i+self.ENDPOINTS_PER_QUERY]
+                # the last chunk is filled up with NULLs, so that there is only one query to prepare
+                chunk += [None] * (self.ENDPOINTS_PER_QUERY - len(chunk))
+                messages.extend(self._execute(query, chunk + [now]).fetchall())
+            return messages
+        endpoints = list(endpoints)
+        query = (self._PUSH_MESSAGES_QUERY + f" WHERE endpoint IN ({','.join('?' * self.ENDPOINTS_PER_QUERY)})"
+                 " AND (attempts=0 OR next_attempt<=?)")
+        return await self._run("get_push_messages_for_endpoints", get)
+
+    async def get_next_push_message_time(self) -> Optional[datetime.datetime]:
+        row = await self._run("get_next_push_message_time", lambda: self._execute(
+            'SELECT MIN(next_attempt) AS "next_attempt [TIMESTAMP]" FROM push_outbox').fetchone())
+        return row["next_attempt"]
+
+    async def update_push_outbox(self, done: Iterable[int], retries: Iterable[Tuple[int, datetime.datetime]],
+                                 dead_letters: Iterable[Tuple[sqlite3.Row, str]], keep_dead_letters_days: int):
+        """
+        Remove the messages with ids in done, schedule the retries ((id, next attempt)) and move the dead letters
+        ((message, error)) from the outbox to push_dead_letters.
+        """
+        def update():
+            now = datetime.datetime.now()
+            self._connection.executemany("UPDATE push_outbox SET attempts=attempts+1, next_attempt=? WHERE id=?",
+                                         ((next_attempt, id_) for id_, next_attempt in retries))
+            self._connection.executemany("INSERT INTO push_dead_letters VALUES (?,?,?,?,?,?)",
+                                         ((m["plan_id"], m["endpoint"], m["payload"], m["attempts"] + 1, error, now)
+                                          for m, error in dead_letters))
+            self._connection.executemany("DELETE FROM push_outbox WHERE id=?",
+                                         [(id_,) for id_ in done] + [(m["id"],) for m, _ in dead_letters])
+            self._execute("DELETE FROM push_payloads WHERE id NOT IN (SELECT payload_id FROM push_outbox)")
+            self._execute("DELETE FROM push_dead_letters WHERE time<?",
+                          (now - datetime.timedelta(days=keep_dead_letters_days),))
+        dead_letters = list(dead_letters)
+        await self._write("update_push_outbox", update)
+
+    async def get_push_outbox_size(self) -> int:
+        return await self._run("get_push_outbox_size",
+                               lambda: self._execute("SELECT COUNT(*) FROM push_outbox").fetchone()[0])
+
+    async def get_push_dead_letter_count(self) -> int:
+        return await self._run("get_push_dead_letter_count",
+                               lambda: self._execute("SELECT COUNT(*) FROM push_dead_letters").fetchone()[0])
+
+    async def delete_expired_push_subscriptions(self, app: web.Application, subscriptions: Iterable[Tuple[str, str]]) \
+            -> Dict[str, int]:
+        """
+        Delete the subscriptions ((plan_id, endpoint)) with one statement per plan. Return the number of deleted
+        subscriptions per plan.
+        """
+        def delete() -> Dict[str, int]:
+            return {plan_id: self._connection.executemany(
+                        "DELETE FROM push_subscriptions2 WHERE plan_id=? AND endpoint=?",
+                        ((plan_id, endpoint) for endpoint in endpoints)).rowcount
+                    for plan_id, endpoints in endpoints_by_plan.items()}
+
+        endpoints_by_plan: Dict[str, Set[str]] = {}
+        for plan_id, endpoint in subscriptions:
+            endpoints_by_plan.setdefault(plan_id, set()).add(endpoint)
+        if not endpoints_by_plan:
+            return {}
+        origins = collections.Counter()
+        for plan_id, endpoints in endpoints_by_plan.items():
+            for endpoint in endpoints:
+                # no more messages are sent to them from now on
+                self.get_push_subscriptions(plan_id).remove(endpoint)
+                origins[urllib.parse.urlparse(endpoint).netloc] += 1
+        counts = await self._write("delete_expired_push_subscriptions", delete)
+        app["logger"].info(f"Deleted {sum(counts.values())} expired push subscriptions ("
+                           + ", ".join(f"{origin}: {n}" for origin, n in origins.most_common()) + ")")
+        return counts
+
+    def get_push_subscriptions(self, plan_id: str) -> PushSubscriptionIndex:
+        """ Return the in-memory index of the plan's push subscriptions, which is kept in sync with the table. """
+        if (index := self._push_subscriptions.get(plan_id)) is None:
+            index = self._push_subscriptions[plan_id] = PushSubscriptionIndex()
+        return index
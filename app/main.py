@@ -14,6 +14,7 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import os
 from functools import partial
 from pathlib import Path
@@ -24,51 +25,80 @@ from aiohttp import web, client, hdrs
 from aiojobs.aiohttp import setup as aiojobs_setup
 
 from . import log_helper
+from . import metrics
 from . import subs_crawler
 from .db import SubstitutionPlanDB
 from .helpers import set_response_headers, error_middleware, render_template, redirect_handler, get_template_handler
+from .push import PushEncryptor, PushOutbox, PushSender, VapidHeaders
 from .settings import Settings, SubsPlanDefinition
+from .subs_crawler.session import CoalescingClientSession
+from .subs_crawler.utils import CLASS_NAME_CACHE
 from .substitution_plan import SubstitutionPlan
 
 THIS_DIR = Path(__file__).parent
 
 DATA_DIR = "/var/lib/openvplan"
 CACHE_DIR = "/var/cache/openvplan"
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshots")
 
 for directory in (
     DATA_DIR,
-    CACHE_DIR
+    CACHE_DIR,
+    SNAPSHOT_DIR
 ):
     os.makedirs(directory, exist_ok=True)
 
 
-BACKGROUND_UPDATES = [
-    # min     hour dom mon dow sec
-    "  0       *    *   *   *   R",  # every hour all the time
-    "15,30,45 5-22  *   *  1-5  R",  # all 15 minutes from 5-22 o'clock on weekdays
-    "46-59     6    *   *  1-5  R",  # every minute on weekdays from 6:46 to 6:59
-    "1-14,16-29,31-44,46-59 7 * * 1-5 R"  # every minute on weekdays from 7:01 to 7:59
-]
-
-
 async def db_context(app):
-    app["db"] = SubstitutionPlanDB(os.path.join(DATA_DIR, "db.sqlite3"))
+    app["db"] = SubstitutionPlanDB(os.path.join(DATA_DIR, "db.sqlite3"), app["settings"].db_commit_delay)
+    await app["db"].open()
     subs_plan: SubstitutionPlan
     for subs_plan in app["substitution_plans"].values():
-        subs_plan.on_db_init(app)
+        await subs_plan.on_db_init(app)
     yield
-    app["db"].close()
+    await app["db"].close()
 
 
 async def client_session_context(app):
     request_headers = app["settings"].request_headers
     timeout = app["settings"].request_timeout
     app["logger"].debug(f"Create ClientSession headers: {request_headers}, timeout: {timeout}s")
-    app["client_session"] = client.ClientSession(headers=request_headers, timeout=client.ClientTimeout(total=timeout))
+    app["client_session"] = client.ClientSession(headers=request_headers, timeout=client.ClientTimeout(total=timeout),
+                                                 trace_configs=[metrics.create_trace_config()])
+    # crawlers of plans using the same upstream server share their requests
+    app["crawler_session"] = CoalescingClientSession(app["client_session"], app["settings"].upstream_response_ttl)
     yield
     await app["client_session"].close()
 
 
+async def push_sender_context(app):
+    settings: Settings = app["settings"]
+    app["push_sender"] = PushSender(settings.push_workers, settings.push_origin_concurrency,
+                                    settings.push_origin_rate, settings.push_max_retries, settings.request_timeout)
+    await app["push_sender"].start()
+    app["vapid_headers"] = VapidHeaders(settings.private_vapid_key, settings.vapid_sub) \
+        if settings.private_vapid_key else None
+    app["push_encryptor"] = PushEncryptor(settings.push_encryption_workers)
+    yield
+    app["push_encryptor"].close()
+    await app["push_sender"].close()
+
+
+async def push_outbox_context(app):
+    settings: Settings = app["settings"]
+    app["push_outbox"] = PushOutbox(app, settings.push_outbox_batch_size, settings.push_outbox_max_attempts)
+    # messages left over from before a restart are sent now
+    await app["push_outbox"].start()
+    yield
+    await app["push_outbox"].close()
+
+
+async def event_loop_lag_context(app):
+    task = asyncio.create_task(metrics.monitor_event_loop_lag())
+    yield
+    task.cancel()
+
+
 async def response_headers_startup(app):
     # call this here so that aiohttp-devtools has already modified app["static_root_url"]
     set_response_headers(app)
@@ -76,8 +106,8 @@ async def response_headers_startup(app):
 
 async def subapp_startup(app):
     for subapp in app["subapps"]:
-        for key in ("settings", "logger", "cache_busting_path", "db", "client_session", "jinja2_env",
-                    "response_headers", "AIOJOBS_SCHEDULER"):
+        for key in ("settings", "logger", "cache_busting_path", "db", "client_session", "crawler_session", "push_sender", "vapid_headers", "push_encryptor",
+                    "push_outbox", "jinja2_env", "response_headers", "AIOJOBS_SCHEDULER"):
             # noinspection PyTypedDict
             subapp[key] = app[key]
 
@@ -95,10 +125,14 @@ async def fix_aiohttp_devtools_bug(app):
     app.on_response_prepare.append(on_prepare)
 
 
-async def cleanup(app):
+async def shutdown(app):
     app["logger"].info("Shutting down...")
+    # stop crawling before the database is closed by db_context
     for subs_plan in app["substitution_plans"].values():
         await subs_plan.cleanup()
+
+
+async def cleanup(app):
     await log_helper.cleanup()
 
 
@@ -137,10 +171,11 @@ async def create_app():
             with open(STATIC_PATH / path, "w") as f:
                 f.write(content)
 
-    app = web.Application(middlewares=[log_helper.logging_middleware, error_middleware])
+    app = web.Application(middlewares=[log_helper.logging_middleware, metrics.metrics_middleware, error_middleware])
 
 
     app["settings"] = settings
+    CLASS_NAME_CACHE.set_maxsize(settings.class_name_cache_size)
 
     await log_helper.init(app)
     logger_ = log_helper.get_logger()
@@ -174,13 +209,17 @@ async def create_app():
 
     app.cleanup_ctx.extend([
         db_context,
-        client_session_context
+        client_session_context,
+        push_sender_context,
+        push_outbox_context,
+        event_loop_lag_context
     ])
 
     app.on_startup.append(response_headers_startup)
 
     app.on_startup.append(subapp_startup)
 
+    app.on_shutdown.append(shutdown)
     app.on_cleanup.append(cleanup)
 
     if settings.debug:
@@ -195,9 +234,11 @@ async def create_app():
         template_options = plan_config["template_options"]
         crawler = crawler(None,  # last_version_id will be set in SubstitutionPlan.set_db
                           **crawler_options)
-        plan = SubstitutionPlan(app, plan_id, crawler, render_template, template_options)
+        plan = SubstitutionPlan(app, plan_id, crawler, render_template, template_options,
+                                os.path.join(SNAPSHOT_DIR, plan_id + ".snapshot"),
+                                plan_config.get("push_debounce", settings.push_debounce))
 
-        subapp = plan.create_app(BACKGROUND_UPDATES)
+        subapp = plan.create_app()
         app["subapps"].append(subapp)
         app.add_subapp(f"/{plan_id}/", subapp)
 
@@ -215,6 +256,10 @@ async def create_app():
         web.get("/about", get_template_handler(app, "about.min.html",
                                                render_args=dict(about_html=settings.about_html)))
     ])
+    if settings.metrics_token or settings.metrics_allowed_addresses:
+        app.add_routes([
+            web.get("/metrics", metrics.get_metrics_handler(settings.metrics_token, settings.metrics_allowed_addresses))
+        ])
     if settings.plausible_embed_link:
         app.add_routes([
             web.get("/plausible", get_template_handler(app, "plausible.min.html",
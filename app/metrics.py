@@ -0,0 +1,317 @@
+#  OpenVPlan
+#  Copyright (C) 2019-2021  Florian Rädiker
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import hmac
+import ipaddress
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web, hdrs
+
+from .subs_crawler.utils import CLASS_NAME_CACHE
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+_LabelValues = Tuple[Tuple[str, str], ...]
+
+# all metrics, in the Prometheus text exposition format at /metrics
+_metrics: List["_Metric"] = []
+
+
+def _format_labels(labels: _LabelValues, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    items = [*labels, *extra]
+    if not items:
+        return ""
+    return "{" + ",".join(
+        f'{key}="' + str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') + '"'
+        for key, value in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> _LabelValues:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return (f"# HELP {self.name} {self.documentation}\n"
+                f"# TYPE {self.name} {self.type}\n" +
+                "".join(sample + "\n" for sample in self._samples()))
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[_LabelValues, float] = {}
+        self._functions: Dict[_LabelValues, Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """ Call function whenever the metrics are collected to get the current value, which must never decrease. """
+        self._functions[self._key(labels)] = function
+
+    def _samples(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+        for labels, function in self._functions.items():
+            yield f"{self.name}{_format_labels(labels)} {_format_value(function())}"
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[_LabelValues, float] = {}
+        self._functions: Dict[_LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """ Call function whenever the metrics are collected to get the current value. """
+        self._functions[self._key(labels)] = function
+
+    def _samples(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+        for labels, function in self._functions.items():
+            yield f"{self.name}{_format_labels(labels)} {_format_value(function())}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [bucket counts..., sum]
+        self._values: Dict[_LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if (values := self._values.get(key)) is None:
+            values = self._values[key] = [0] * len(self._buckets) + [0.0]
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                values[i] += 1
+        values[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t1, **labels)
+
+    def _samples(self):
+        for labels, values in self._values.items():
+            for bound, count in zip(self._buckets, values):
+                yield f"{self.name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {count}"
+            yield f"{self.name}_sum{_format_labels(labels)} {_format_value(values[-1])}"
+            yield f"{self.name}_count{_format_labels(labels)} {values[-2]}"
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in _metrics)
+
+
+# CRAWLING
+CRAWL_DURATION = Histogram("openvplan_crawl_duration_seconds",
+                           "Time needed to update a substitution plan from upstream", ["plan"])
+UPDATES = Counter("openvplan_updates_total",
+                  "Substitution plan updates by result (changed, unchanged or error)", ["plan", "result"])
+CRAWLER_STAGE_DURATION = Histogram("openvplan_crawler_stage_duration_seconds",
+                                   "Time needed for parsing and diffing substitutions", ["plan", "stage"])
+# requests are shared between plans using the same upstream server (see CoalescingClientSession), so they are
+# counted per host instead of per plan
+UPSTREAM_REQUESTS = Counter("openvplan_upstream_requests_total",
+                            "Requests made to upstream servers by host and response status", ["host", "status"])
+UPSTREAM_BYTES = Counter("openvplan_upstream_response_bytes_total",
+                         "Bytes received from upstream servers by host", ["host"])
+
+# RENDERING AND REQUESTS
+RENDER_DURATION = Histogram("openvplan_render_duration_seconds", "Time needed to render a substitution plan",
+                            ["plan"])
+REQUEST_DURATION = Histogram("openvplan_request_duration_seconds", "Time needed to handle a request",
+                             ["route", "method", "status"])
+
+# WEBSOCKETS
+OPEN_WEBSOCKETS = Gauge("openvplan_open_websockets", "Currently open WebSocket connections", ["plan"])
+BROADCAST_DURATION = Histogram("openvplan_websocket_broadcast_duration_seconds",
+                               "Time needed to send an update to all WebSocket connections", ["plan"])
+
+# PUSH NOTIFICATIONS
+PUSH_SENT = Counter("openvplan_push_notifications_total", "Push notifications sent by response status",
+                    ["plan", "status"])
+PUSH_FANOUT_DURATION = Histogram("openvplan_push_fanout_duration_seconds",
+                                 "Time needed to add the push notifications for one update to the outbox", ["plan"],
+                                 buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+PUSH_FANOUT_PAYLOADS = Gauge("openvplan_push_fanout_payloads",
+                             "Distinct payloads, i.e. groups of subscriptions, in the last fan-out", ["plan"])
+PUSH_DEBOUNCED_UPDATES = Counter("openvplan_push_debounced_updates_total",
+                                 "Updates merged into the push messages of a previous update", ["plan"])
+PUSH_REQUEST_DURATION = Histogram("openvplan_push_request_duration_seconds",
+                                  "Time needed for one request to a push service", ["service"])
+PUSH_RETRIES = Counter("openvplan_push_retries_total", "Push messages retried because of 429, 5xx or errors",
+                       ["service"])
+VAPID_SIGNATURES = Counter("openvplan_vapid_signatures_total", "VAPID authorization headers signed")
+PUSH_QUEUE_SIZE = Gauge("openvplan_push_queue_size", "Push messages waiting to be sent")
+PUSH_OUTBOX_SIZE = Gauge("openvplan_push_outbox_size", "Push messages in the outbox, including scheduled retries")
+PUSH_OUTBOX_PROCESSED = Counter("openvplan_push_outbox_processed_total",
+                                "Push messages processed from the outbox by result "
+                                "(sent, expired, dropped, retry or dead_letter)", ["result"])
+PUSH_OUTBOX_DRAIN_RATE = Gauge("openvplan_push_outbox_drain_rate",
+                               "Push messages per second processed in the last outbox batch")
+PUSH_OUTBOX_COMBINED = Counter("openvplan_push_outbox_combined_total",
+                               "Push messages sent together with another message for the same device")
+PUSH_DEAD_LETTERS = Gauge("openvplan_push_dead_letters", "Push messages which could not be delivered")
+PUSH_SUBSCRIPTIONS_DELETED = Counter("openvplan_push_subscriptions_deleted_total",
+                                     "Push subscriptions deleted because they expired", ["plan"])
+
+# DATABASE
+DB_OPERATION_DURATION = Histogram("openvplan_db_operation_duration_seconds",
+                                  "Time needed for a database operation, including waiting for the database's thread",
+                                  ["operation"],
+                                  buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+DB_WRITES_PER_COMMIT = Histogram("openvplan_db_writes_per_commit", "Writes committed together in one transaction",
+                                 buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+# EVENT LOOP
+EVENT_LOOP_LAG = Histogram("openvplan_event_loop_lag_seconds",
+                           "Delay of the event loop, e.g. while sending push notifications",
+                           buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+
+# CACHES
+CLASS_NAME_CACHE_REQUESTS = Counter("openvplan_class_name_cache_requests_total",
+                                    "Lookups in the cache for parsed class names and lessons", ["result"])
+CLASS_NAME_CACHE_REQUESTS.set_function(lambda: CLASS_NAME_CACHE.cache_info().hits, result="hit")
+CLASS_NAME_CACHE_REQUESTS.set_function(lambda: CLASS_NAME_CACHE.cache_info().misses, result="miss")
+CLASS_NAME_CACHE_ENTRIES = Gauge("openvplan_class_name_cache_entries",
+                                 "Entries in the cache for parsed class names and lessons")
+CLASS_NAME_CACHE_ENTRIES.set_function(lambda: CLASS_NAME_CACHE.cache_info().currsize)
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """ Count requests and received bytes for all upstream requests made with a session. """
+    async def on_request_end(session, ctx, params: aiohttp.TraceRequestEndParams):
+        UPSTREAM_REQUESTS.inc(host=params.url.host, status=params.response.status)
+
+    async def on_request_exception(session, ctx, params: aiohttp.TraceRequestExceptionParams):
+        UPSTREAM_REQUESTS.inc(host=params.url.host, status="error")
+
+    async def on_response_chunk_received(session, ctx, params: aiohttp.TraceResponseChunkReceivedParams):
+        UPSTREAM_BYTES.inc(len(params.chunk), host=params.url.host)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
+
+async def monitor_event_loop_lag(interval: float = .25):
+    """ Measure how much later than requested the event loop wakes up a sleeping task. """
+    loop = asyncio.get_running_loop()
+    while True:
+        t1 = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - t1 - interval, 0))
+
+
+def get_route_name(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    t1 = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_DURATION.observe(time.perf_counter() - t1, route=get_route_name(request), method=request.method,
+                                 status=status)
+
+
+def get_metrics_handler(token: Optional[str], allowed_addresses: Iterable[str]):
+    networks = [ipaddress.ip_network(address, strict=False) for address in allowed_addresses]
+
+    def is_allowed(request: web.Request) -> bool:
+        if token:
+            auth = request.headers.get(hdrs.AUTHORIZATION, "")
+            # compare_digest() only accepts ASCII str, header values may contain anything. aiohttp decodes them
+            # with surrogateescape
+            if auth.startswith("Bearer ") and hmac.compare_digest(auth[7:].encode("utf-8", "surrogateescape"),
+                                                                  token.encode()):
+                return True
+        if networks and request.remote:
+            try:
+                address = ipaddress.ip_address(request.remote)
+            except ValueError:
+                return False
+            return any(address in network for network in networks)
+        return False
+
+    async def handler(request: web.Request):
+        if not is_allowed(request):
+            raise web.HTTPForbidden()
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Robots-Tag": "noindex"})
+    return handler
@@ -0,0 +1,492 @@
+#  OpenVPlan
+#  Copyright (C) 2019-2021  Florian Rädiker
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import base64
+import concurrent.futures
+import datetime
+import email.utils
+import hashlib
+import logging
+import random
+import re
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+from urllib.parse import urlparse
+
+import aiohttp
+import pywebpush
+from aiohttp import hdrs, web
+
+from . import log_helper, metrics
+from .db import hash_endpoint
+
+_LOGGER = logging.getLogger("openvplan")
+
+# Intercept pywebpush.WebPusher.as_curl() call in pywebpush.WebPusher.send() so that request can be made with aiohttp.
+# A call to pywebpush.webpush(..., curl=True) will now return (endpoint, data, headers).
+pywebpush.WebPusher.as_curl = lambda self, endpoint, encoded_data, headers: (endpoint, encoded_data, headers)
+
+_EncryptedMessage = Tuple[str, bytes, Dict[str, str]]
+
+# seconds a push service keeps a message for an offline device if nothing else is specified
+DEFAULT_TTL = 24*60*60
+
+
+def get_topic(name: str) -> str:
+    """
+    Return a value for the Topic header. A message replaces undelivered messages with the same topic. Topics must
+    consist of at most 32 characters of the URL-safe base64 alphabet, other names are hashed.
+    """
+    if re.fullmatch(r"[A-Za-z0-9_-]{1,32}", name):
+        return name
+    return base64.urlsafe_b64encode(hashlib.blake2b(name.encode("utf-8"), digest_size=24).digest()).decode("ascii")
+
+
+class VapidHeaders:
+    """
+    Signing a VAPID JWT is expensive, but there are only a few audiences (the push services' origins). So the
+    authorization header is signed once per audience and reused until shortly before it expires.
+    """
+
+    # exp must not be more than 24 hours in the future
+    LIFETIME = 12*60*60
+    RENEW_BEFORE = 60*60
+
+    def __init__(self, private_key: str, sub: str):
+        self._vapid = pywebpush.Vapid.from_string(private_key=private_key)
+        self._sub = sub
+        # audience -> (exp, headers)
+        self._headers: Dict[str, Tuple[int, Dict[str, str]]] = {}
+
+    def get(self, aud: str) -> Dict[str, str]:
+        now = time.time()
+        cached = self._headers.get(aud)
+        if cached is None or cached[0] - self.RENEW_BEFORE <= now:
+            exp = int(now) + self.LIFETIME
+            cached = self._headers[aud] = (exp, self._vapid.sign({"sub": self._sub, "aud": aud, "exp": exp}))
+            metrics.VAPID_SIGNATURES.inc()
+            _LOGGER.debug(f"Signed VAPID header for {aud}, valid until {exp}")
+        return cached[1]
+
+
+def _encrypt_batch(messages: List[Tuple[dict, str, Dict[str, str], str, int]]) \
+        -> List[Union[_EncryptedMessage, Exception]]:
+    results = []
+    for subscription, data, headers, content_encoding, ttl in messages:
+        # noinspection PyBroadException
+        try:
+            results.append(pywebpush.webpush(subscription, data, headers=headers, content_encoding=content_encoding,
+                                             ttl=ttl, curl=True))  # see as_curl above
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class PushEncryptor:
+    """
+    Encrypts push messages in a thread pool, so that the key agreement and encryption for thousands of
+    subscriptions don't block the event loop. Messages requested at the same time are encrypted in batches of
+    BATCH_SIZE to keep the overhead per message low.
+    """
+
+    BATCH_SIZE = 50
+
+    def __init__(self, workers: int):
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="push-encryption")
+        self._pending: List[Tuple[Tuple[dict, str, Dict[str, str], str, int], asyncio.Future]] = []
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def encrypt(self, subscription: dict, data: str, headers: Dict[str, str], content_encoding: str,
+                      ttl: int = DEFAULT_TTL) -> _EncryptedMessage:
+        """ Return (endpoint, body, headers) for a push message. """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._pending:
+            # collect all messages requested in this iteration of the event loop
+            loop.call_soon(self._flush)
+        self._pending.append(((subscription, data, headers, content_encoding, ttl), future))
+        return await future
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        for i in range(0, len(pending), self.BATCH_SIZE):
+            batch = pending[i:i+self.BATCH_SIZE]
+            batch_future = loop.run_in_executor(self._executor, _encrypt_batch, [message for message, _ in batch])
+            batch_future.add_done_callback(lambda f, futures=[f for _, f in batch]: self._set_results(f, futures))
+
+    @staticmethod
+    def _set_results(batch_future: asyncio.Future, futures: List[asyncio.Future]):
+        if batch_future.exception() is not None:
+            results = [batch_future.exception()] * len(futures)
+        else:
+            results = batch_future.result()
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class PushResult(NamedTuple):
+    status: int
+    reason: Optional[str]
+    text: str
+
+
+class _Origin:
+    """ Concurrency and rate limit for one push service. """
+
+    def __init__(self, name: str, concurrency: int, rate: float):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_time = 0.0
+        # set when the push service answered with 429 Too Many Requests
+        self.blocked_until = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        t = max(now, self._next_time, self.blocked_until)
+        self._next_time = t + self._interval
+        if t > now:
+            await asyncio.sleep(t - now)
+
+
+class _Job:
+    __slots__ = ("endpoint", "data", "headers", "future", "max_retries", "attempt")
+
+    def __init__(self, endpoint: str, data: bytes, headers: Dict[str, str], future: asyncio.Future,
+                 max_retries: int):
+        self.endpoint = endpoint
+        self.data = data
+        self.headers = headers
+        self.future = future
+        self.max_retries = max_retries
+        self.attempt = 0
+
+
+class PushSender:
+    """
+    Sends push messages with a fixed number of workers, so that a fan-out to thousands of subscriptions doesn't open
+    thousands of connections at once. Requests to each push service (e.g. FCM or Mozilla autopush) are additionally
+    limited to origin_concurrency simultaneous requests and origin_rate requests per second. Requests failing with
+    429, 5xx or a connection error are retried with exponential backoff, honoring Retry-After.
+    """
+
+    RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+    RETRY_BASE_DELAY = 1
+    RETRY_MAX_DELAY = 5*60
+
+    def __init__(self, workers: int, origin_concurrency: int, origin_rate: float, max_retries: int,
+                 timeout: float):
+        self._workers = workers
+        self._origin_concurrency = origin_concurrency
+        self._origin_rate = origin_rate
+        self._max_retries = max_retries
+        self._timeout = timeout
+        self._origins: Dict[str, _Origin] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        metrics.PUSH_QUEUE_SIZE.set_function(lambda: self._queue.qsize() if self._queue else 0)
+
+    async def start(self):
+        # a separate session, so that a fan-out doesn't use up the connections needed for crawling
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._workers),
+                                              timeout=aiohttp.ClientTimeout(total=self._timeout))
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._session.close()
+
+    async def send(self, endpoint: str, data: bytes, headers: Dict[str, str], max_retries: Optional[int] = None) \
+            -> PushResult:
+        """
+        Send a push message and return the push service's final answer. Raises if all attempts failed.
+
+        :param max_retries: overrides the sender's max_retries, e.g. 0 if the caller retries itself
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Job(endpoint, data, headers, future,
+                                    self._max_retries if max_retries is None else max_retries))
+        return await future
+
+    def _get_origin(self, endpoint: str) -> _Origin:
+        url = urlparse(endpoint)
+        origin = f"{url.scheme}://{url.netloc}"
+        if (o := self._origins.get(origin)) is None:
+            o = self._origins[origin] = _Origin(url.netloc, self._origin_concurrency, self._origin_rate)
+        return o
+
+    def _get_retry_delay(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after:
+            # either seconds or an HTTP date
+            try:
+                return min(max(float(retry_after), 0), self.RETRY_MAX_DELAY)
+            except ValueError:
+                try:
+                    t = email.utils.parsedate_to_datetime(retry_after)
+                    return min(max((t - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0),
+                               self.RETRY_MAX_DELAY)
+                except (TypeError, ValueError):
+                    pass
+        return min(self.RETRY_BASE_DELAY * 2 ** attempt * random.uniform(1, 1.5), self.RETRY_MAX_DELAY)
+
+    async def _worker(self):
+        while True:
+            job: _Job = await self._queue.get()
+            if job.future.done():
+                # the sender isn't waiting anymore
+                continue
+            # noinspection PyBroadException
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    async def _process(self, job: _Job):
+        origin = self._get_origin(job.endpoint)
+        result = None
+        retry_after = None
+        error = None
+        async with origin.semaphore:
+            await origin.wait()
+            t1 = time.perf_counter()
+            try:
+                async with self._session.post(job.endpoint, data=job.data, headers=job.headers) as r:
+                    result = PushResult(r.status, r.reason, await r.text())
+                    retry_after = r.headers.get(hdrs.RETRY_AFTER)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            metrics.PUSH_REQUEST_DURATION.observe(time.perf_counter() - t1, service=origin.name)
+
+        if (result is None or result.status in self.RETRY_STATUSES) and job.attempt < job.max_retries:
+            delay = self._get_retry_delay(job.attempt, retry_after)
+            if result is not None and result.status == 429:
+                # slow down all requests to this push service
+                origin.blocked_until = max(origin.blocked_until, time.monotonic() + delay)
+            job.attempt += 1
+            metrics.PUSH_RETRIES.inc(service=origin.name)
+            _LOGGER.debug(f"Retrying push message to {origin.name} in {delay:.1f}s (attempt {job.attempt}): "
+                          f"{result.status if result else repr(error)}")
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+            return
+        if job.future.done():
+            return
+        if result is None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+
+class _OutboxMessage(NamedTuple):
+    index: int
+    row: Any
+    plan: Any
+    subscription: dict
+    expires: datetime.datetime
+
+
+class PushOutbox:
+    """
+    Sends the push messages in the database's outbox (see SubstitutionPlanDB.enqueue_push_messages()) in batches of
+    batch_size. A message is only removed from the outbox after the push service answered, so messages aren't lost
+    when the process stops during a fan-out. Messages failing with 429, 5xx or an error are retried later with
+    exponential backoff. They are sent without PushSender's retries, so that a slow push service doesn't hold up
+    the outbox. After max_attempts attempts, or on other errors, they are moved to the dead letters.
+    """
+
+    RETRY_BASE_DELAY = 30
+    RETRY_MAX_DELAY = 60*60
+    # messages without an expiry are sent with a TTL of DEFAULT_TTL, so older ones are dropped
+    MAX_AGE = datetime.timedelta(seconds=DEFAULT_TTL)
+    DEAD_LETTERS_KEEP_DAYS = 7
+    # push services accept payloads of about 4 KB
+    MAX_COMBINED_PAYLOAD_SIZE = 3800
+    URGENCIES = ["very-low", "low", "normal", "high"]
+
+    def __init__(self, app: web.Application, batch_size: int, max_attempts: int):
+        self._app = app
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def wake(self):
+        """ Call after messages were added to the outbox. """
+        self._event.set()
+
+    async def _run(self):
+        log_helper.REQUEST_ID_CONTEXTVAR.set("push-outbox")
+        while True:
+            self._event.clear()
+            # noinspection PyBroadException
+            try:
+                while await self._process_batch():
+                    pass
+                await self._update_metrics()
+                next_attempt = await self._app["db"].get_next_push_message_time()
+                timeout = max((next_attempt - datetime.datetime.now()).total_seconds(), 0) \
+                    if next_attempt is not None else None
+            except Exception:
+                _LOGGER.exception("Sending push messages from outbox failed")
+                timeout = self.RETRY_BASE_DELAY
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process_batch(self) -> bool:
+        """ Return whether there may be more due messages. """
+        db = self._app["db"]
+        now = datetime.datetime.now()
+        messages = await db.get_due_push_messages(now, self._batch_size)
+        if not messages:
+            return False
+        t1 = time.perf_counter()
+        # A device subscribed to several plans has the same endpoint for all of them. Its new messages which are not
+        # due yet, e.g. from another plan updated at the same time, are sent now as well, combined into one message.
+        messages_by_endpoint: Dict[str, List] = {}
+        for m in await db.get_push_messages_for_endpoints({m["endpoint"] for m in messages}, now):
+            messages_by_endpoint.setdefault(m["endpoint"], []).append(m)
+        results = await asyncio.gather(*(self._send(m, now) for m in messages_by_endpoint.values()))
+
+        done = []
+        retries = []
+        dead_letters = []
+        expired: Set[Tuple[str, str]] = set()
+        count = 0
+        for endpoint_messages, endpoint_results in zip(messages_by_endpoint.values(), results):
+            for m, (result, error) in zip(endpoint_messages, endpoint_results):
+                count += 1
+                if result == "retry" and m["attempts"] + 1 >= self._max_attempts:
+                    result = "dead_letter"
+                if result == "retry":
+                    delay = min(self.RETRY_BASE_DELAY * 2 ** m["attempts"] * random.uniform(1, 1.5),
+                                self.RETRY_MAX_DELAY)
+                    retries.append((m["id"], datetime.datetime.now() + datetime.timedelta(seconds=delay)))
+                elif result == "dead_letter":
+                    _LOGGER.warning(f"Giving up push message to {m['plan_id']}-{hash_endpoint(m['endpoint'])[:6]} "
+                                    f"after {m['attempts'] + 1} attempts: {error}")
+                    dead_letters.append((m, error))
+                else:
+                    if result == "expired":
+                        # If status code is 404 or 410, the endpoints are unavailable, so delete the
+                        # subscription. See https://autopush.readthedocs.io/en/latest/http.html#error-codes.
+                        expired.add((m["plan_id"], m["endpoint"]))
+                    done.append(m["id"])
+                metrics.PUSH_OUTBOX_PROCESSED.inc(result=result)
+        await db.update_push_outbox(done, retries, dead_letters, self.DEAD_LETTERS_KEEP_DAYS)
+        for plan_id, deleted in (await db.delete_expired_push_subscriptions(self._app, expired)).items():
+            metrics.PUSH_SUBSCRIPTIONS_DELETED.inc(deleted, plan=plan_id)
+        await self._update_metrics()
+
+        duration = time.perf_counter() - t1
+        metrics.PUSH_OUTBOX_DRAIN_RATE.set(count / duration if duration else 0)
+        _LOGGER.debug(f"Processed {count} push messages for {len(messages_by_endpoint)} devices from outbox in "
+                      f"{duration:.2f}s ({len(done)} done, {len(retries)} retries, {len(dead_letters)} dead letters)")
+        return len(messages) == self._batch_size
+
+    async def _update_metrics(self):
+        metrics.PUSH_OUTBOX_SIZE.set(await self._app["db"].get_push_outbox_size())
+        metrics.PUSH_DEAD_LETTERS.set(await self._app["db"].get_push_dead_letter_count())
+
+    def _combine(self, messages: List[_OutboxMessage]) -> List[List[_OutboxMessage]]:
+        """ Split messages into groups whose payloads fit into one push message together. """
+        groups = []
+        size = 0
+        for m in messages:
+            if groups and size + len(m.row["payload"]) + 1 <= self.MAX_COMBINED_PAYLOAD_SIZE:
+                groups[-1].append(m)
+                size += len(m.row["payload"]) + 1
+            else:
+                groups.append([m])
+                size = len(m.row["payload"]) + len('{"type":"subs_updates","updates":[]}')
+        return groups
+
+    async def _send(self, messages: List, now: datetime.datetime) -> List[Tuple[str, Optional[str]]]:
+        """
+        Send all messages for one endpoint and return (result, error) for each one. result is one of sent, expired,
+        dropped, retry or dead_letter.
+        """
+        results: List[Optional[Tuple[str, Optional[str]]]] = [None] * len(messages)
+        sendable = []
+        for i, row in enumerate(messages):
+            plan = self._app["substitution_plans"].get(row["plan_id"])
+            subscription = self._app["db"].get_push_subscriptions(row["plan_id"]).get(row["endpoint"])
+            expires = row["expires"] or row["created"] + self.MAX_AGE
+            if plan is None or subscription is None or expires <= now:
+                # the plan was removed, the subscription was deleted in the meantime or the message is outdated
+                results[i] = ("dropped", None)
+            else:
+                sendable.append(_OutboxMessage(i, row, plan, subscription, expires))
+
+        for group in self._combine(sendable):
+            if len(group) == 1:
+                payload = group[0].row["payload"]
+            else:
+                payload = '{"type":"subs_updates","updates":[' + ",".join(m.row["payload"] for m in group) + "]}"
+                metrics.PUSH_OUTBOX_COMBINED.inc(len(group) - 1)
+            headers = {}
+            topics = {m.row["topic"] for m in group}
+            if len(topics) == 1 and (topic := topics.pop()):
+                # messages for different plans must not replace each other
+                headers["Topic"] = topic
+            urgencies = [m.row["urgency"] for m in group if m.row["urgency"]]
+            if urgencies:
+                headers["Urgency"] = max(urgencies, key=self.URGENCIES.index)
+            ttl = int((max(m.expires for m in group) - now).total_seconds())
+            m = group[0]
+            try:
+                r = await m.plan.deliver_push_notification(self._app, m.subscription, payload, headers, ttl,
+                                                           max_retries=0)
+            except Exception as e:
+                result = ("retry", repr(e))
+            else:
+                if r.status in (404, 410):
+                    result = ("expired", None)
+                elif r.status in PushSender.RETRY_STATUSES:
+                    result = ("retry", f"{r.status} {r.reason}")
+                elif r.status >= 400:
+                    result = ("dead_letter", f"{r.status} {r.reason} {r.text!r}")
+                else:
+                    result = ("sent", None)
+            for m in group:
+                results[m.index] = result
+        return results
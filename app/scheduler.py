@@ -0,0 +1,144 @@
+#  OpenVPlan
+#  Copyright (C) 2019-2021  Florian Rädiker
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import logging
+import random
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Iterable, Optional, Tuple
+
+_LOGGER = logging.getLogger("openvplan")
+
+
+class AdaptivePollingScheduler:
+    """
+    Polls a substitution plan densely around the times at which its status usually changes and backs off
+    exponentially otherwise.
+
+    Status changes are grouped into slots of SLOT_MINUTES minutes per weekday. A slot in which the status changed at
+    least HOT_SLOT_MIN_CHANGES times within the last HISTORY_DAYS days is "hot", and so is the slot right before it.
+    As long as fewer than MIN_HISTORY_CHANGES changes are known, DEFAULT_HOT_SLOTS are used instead.
+    """
+
+    SLOT_MINUTES = 15
+    HISTORY_DAYS = 28
+    HOT_SLOT_MIN_CHANGES = 2
+    MIN_HISTORY_CHANGES = 10
+    # weekdays from 6:45 to 7:59
+    DEFAULT_HOT_SLOTS = frozenset((weekday, slot) for weekday in range(5) for slot in range(27, 32))
+
+    def __init__(self, min_interval: float, max_interval: float, jitter: float):
+        self._poll: Optional[Callable[[], Awaitable]] = None
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._jitter = jitter
+
+        self._changes: list = []
+        self._hot_slots = self.DEFAULT_HOT_SLOTS
+        self._quiet_polls = 0
+        self._last_update: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def _get_slot(cls, t: datetime.datetime) -> Tuple[int, int]:
+        return t.weekday(), (t.hour * 60 + t.minute) // cls.SLOT_MINUTES
+
+    def set_history(self, changes: Iterable[datetime.datetime]):
+        self._changes = sorted(changes)
+        self._update_hot_slots()
+
+    def _update_hot_slots(self):
+        since = datetime.datetime.now() - datetime.timedelta(days=self.HISTORY_DAYS)
+        self._changes = [t for t in self._changes if t >= since]
+        if len(self._changes) < self.MIN_HISTORY_CHANGES:
+            self._hot_slots = self.DEFAULT_HOT_SLOTS
+            return
+        slots_per_day = 24 * 60 // self.SLOT_MINUTES
+        counts = Counter(self._get_slot(t) for t in self._changes)
+        hot_slots = set()
+        for (weekday, slot), count in counts.items():
+            if count >= self.HOT_SLOT_MIN_CHANGES:
+                hot_slots.add((weekday, slot))
+                # also poll densely right before the usual time
+                if slot > 0:
+                    hot_slots.add((weekday, slot - 1))
+                else:
+                    hot_slots.add(((weekday - 1) % 7, slots_per_day - 1))
+        self._hot_slots = frozenset(hot_slots)
+
+    def on_update(self, status_changed: bool, now: datetime.datetime = None):
+        """ Called after every update of the plan, including updates triggered by visitors. """
+        self._last_update = time.monotonic()
+        if status_changed:
+            self._quiet_polls = 0
+            self._changes.append(now or datetime.datetime.now())
+            self._update_hot_slots()
+        else:
+            self._quiet_polls += 1
+
+    def is_hot(self, t: datetime.datetime) -> bool:
+        return self._get_slot(t) in self._hot_slots
+
+    def _seconds_until_hot(self, now: datetime.datetime) -> float:
+        slot_start = now.replace(minute=now.minute - now.minute % self.SLOT_MINUTES, second=0, microsecond=0)
+        t = slot_start
+        while (t - now).total_seconds() < self._max_interval:
+            t += datetime.timedelta(minutes=self.SLOT_MINUTES)
+            if self.is_hot(t):
+                return (t - now).total_seconds()
+        return self._max_interval
+
+    def get_interval(self, now: datetime.datetime = None) -> float:
+        now = now or datetime.datetime.now()
+        if self.is_hot(now):
+            interval = self._min_interval
+        else:
+            interval = min(self._min_interval * 2 ** min(self._quiet_polls, 16), self._seconds_until_hot(now))
+        interval *= 1 + random.uniform(-self._jitter, self._jitter)
+        return min(max(interval, self._min_interval), self._max_interval)
+
+    async def _run(self):
+        while True:
+            if self._last_update is not None:
+                # visitors' requests also update the plan, so only poll when nobody else did
+                delay = self._last_update + self.get_interval() - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    if self._last_update + self._min_interval > time.monotonic():
+                        continue
+            # noinspection PyBroadException
+            try:
+                await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _LOGGER.exception("Exception in background update")
+                self.on_update(False)
+
+    def start(self, poll: Callable[[], Awaitable]):
+        self._poll = poll
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -35,11 +35,15 @@ class _CrawlerDefinition(TypedDict):
     options: dict
 
 
-class SubsPlanDefinition(TypedDict):
+class _SubsPlanDefinitionRequired(TypedDict):
     crawler: _CrawlerDefinition
     template_options: Dict[str, Any]
 
 
+class SubsPlanDefinition(_SubsPlanDefinitionRequired, total=False):
+    push_debounce: float
+
+
 class _NewsDefinition(BaseModel):
     html: Union[str, list]
     date: Optional[datetime.date] = None
@@ -128,6 +132,8 @@ class Settings(BaseSettings):
 
     domain: str = ""
 
+    db_commit_delay: float = 0.002
+
     title: str = "OpenVPlan"
     title_big: str = "OpenVPlan"
     title_middle: str = "OpenVPlan"
@@ -141,6 +147,15 @@ class Settings(BaseSettings):
     vapid_sub: Optional[str] = None
     webpush_content_encoding: str = "aes128gcm"
     send_welcome_push_message: bool = False
+    push_workers: int = 50
+    push_origin_concurrency: int = 20
+    push_origin_rate: float = 100
+    push_max_retries: int = 3
+    push_encryption_workers: int = 2
+    push_outbox_batch_size: int = 500
+    push_outbox_max_attempts: int = 5
+    push_debounce: float = 0
+    push_dedup_window: float = 5
 
     plausible_domain: Optional[str] = None
     plausible_js: str = "https://plausible.io/js/plausible.outbound-links.js"
@@ -159,11 +174,21 @@ class Settings(BaseSettings):
 
     request_headers: Dict[str, str] = {}
     request_timeout: float = 10
+    upstream_response_ttl: float = 10
+    class_name_cache_size: int = 4096
+
+    polling_min_interval: float = 60
+    polling_max_interval: float = 60*60
+    polling_jitter: float = 0.1
+    version_history_size: int = 50
 
     additional_csp_directives: dict = {}
 
     headers_block_floc: bool = True
 
+    metrics_token: Optional[str] = None
+    metrics_allowed_addresses: List[str] = []
+
 
     # the following settings are preferably loaded through files in the /config directory because of their size
 
@@ -17,7 +17,7 @@
 from .crawlers.dsbmobile import DsbmobileSubstitutionCrawler
 from .crawlers.multipage import MultiPageSubstitutionCrawler
 from .crawlers.webuntis import WebuntisCrawler
-from .parsers.untis import UntisSubstitutionParser
+from .parsers import PARSERS
 
 __all__ = ["CRAWLERS", "PARSERS"]
 
@@ -27,10 +27,6 @@ CRAWLERS = {
     "webuntis": WebuntisCrawler
 }
 
-PARSERS = {
-    "untis": UntisSubstitutionParser
-}
-
 
 def get_crawler(name: str):
     try:
@@ -15,12 +15,16 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import json
 import logging
+import time
+import zlib
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 import aiohttp
 
+from ..diff import StorageChanges
 from ..parsers.base import BaseSubstitutionParser
 from ..storage import SubstitutionStorage
 
@@ -28,6 +32,7 @@ _LOGGER = logging.getLogger("openvplan")
 
 
 class BaseSubstitutionCrawler(ABC):
+    # first byte of snapshots, increase when the format of SubstitutionStorage.to_snapshot() changes
     _STORAGE_VERSION = b"\x01"
 
     _storage: "SubstitutionStorage"
@@ -37,10 +42,58 @@ class BaseSubstitutionCrawler(ABC):
 
         self._storage: Optional[SubstitutionStorage] = None
 
+        # called with a stage name ("parse" or "diff") and the time needed for it in ns
+        self.on_timing: Optional[Callable[[str, int], Any]] = None
+        # called with the changes whenever a new storage was compared to the previous one
+        self.on_changes: Optional[Callable[[StorageChanges], Any]] = None
+
     @property
     def storage(self) -> "SubstitutionStorage":
         return self._storage
 
+    def get_snapshot(self) -> Optional[bytes]:
+        """ Serialize the current storage so that it can be restored with load_snapshot() after a restart. """
+        if self._storage is None:
+            return None
+        data = json.dumps({"version_id": self.last_version_id, "storage": self._storage.to_snapshot()},
+                          separators=(",", ":")).encode("utf-8")
+        return self._STORAGE_VERSION + zlib.compress(data)
+
+    def load_snapshot(self, snapshot: bytes) -> bool:
+        """
+        Restore the storage from a snapshot created by get_snapshot(). The snapshot is only used if it belongs to
+        the current last_version_id, i.e. if the plan did not change since it was created.
+
+        :return: whether the snapshot was used
+        """
+        if not snapshot.startswith(self._STORAGE_VERSION):
+            _LOGGER.warning("Ignoring snapshot with different storage version")
+            return False
+        data = json.loads(zlib.decompress(snapshot[len(self._STORAGE_VERSION):]))
+        if data["version_id"] != self.last_version_id:
+            _LOGGER.info(f"Ignoring outdated snapshot (version id {data['version_id']!r})")
+            return False
+        storage = SubstitutionStorage.from_snapshot(data["storage"])
+        storage.remove_old_days()
+        self._storage = storage
+        return True
+
+    def _report_timing(self, stage: str, t1: int):
+        if self.on_timing:
+            self.on_timing(stage, time.perf_counter_ns() - t1)
+
+    def _get_new_affected_groups(self, storage: SubstitutionStorage) \
+            -> Dict[datetime.date, Dict[str, Union[str, List[str]]]]:
+        t1 = time.perf_counter_ns()
+        # reuse unchanged objects from the current storage, this also makes the diff faster
+        storage.share_unchanged(self._storage)
+        changes = storage.get_changes(self._storage)
+        affected_groups = changes.get_affected_groups()
+        self._report_timing("diff", t1)
+        if self.on_changes:
+            self.on_changes(changes)
+        return affected_groups
+
     @abstractmethod
     async def update(self, session: aiohttp.ClientSession) \
             -> Tuple[bool, Optional[Dict[datetime.date, Dict[str, Union[str, List[str]]]]]]:
@@ -16,69 +16,107 @@
 
 import asyncio
 import datetime
+import hashlib
 import logging
 import time
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 import aiohttp
+from aiohttp import hdrs
 
 from ..crawlers.base import BaseSubstitutionCrawler
-from ..parsers.base import BaseMultiPageSubstitutionParser
-from ..storage import SubstitutionStorage
+from ..parsers import get_parser
+from ..parsers.base import AsyncBytesIOWrapper, BaseMultiPageSubstitutionParser
+from ..storage import SubstitutionDay, SubstitutionStorage
 
 _LOGGER = logging.getLogger("openvplan")
 
 
+class _CachedPage:
+    def __init__(self, etag: Optional[str], last_modified: Optional[str], content_hash: bytes,
+                 storage: SubstitutionStorage):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.storage = storage
+
+
 class DsbmobileSubstitutionCrawler(BaseSubstitutionCrawler):
     BASE_URL = "https://mobileapi.dsbcontrol.de"
+    TOKEN_LIFETIME = 60*60  # request a new token every hour
 
     _parser_class: Type[BaseMultiPageSubstitutionParser]
 
-    def __init__(self, parser_class: Type[BaseMultiPageSubstitutionParser], parser_options: Dict[str, Any],
+    def __init__(self, last_version_id,
+                 parser_name: str, parser_options: Dict[str, Any],
                  username: str, password: str, timeout_total: float = None, timeout_connect: float = None,
                  timeout_sock_read: float = None, timeout_sock_connect: float = None):
-        super().__init__(parser_class, parser_options)
+        super().__init__(last_version_id)
+        self._parser_class = get_parser(parser_name)
+        self._parser_options = parser_options
         self._username = username
         self._password = password
         self._timeout = aiohttp.ClientTimeout(total=timeout_total, connect=timeout_connect, sock_read=timeout_sock_read,
                                               sock_connect=timeout_sock_connect)
 
+        self._token: Optional[str] = None
+        self._token_expiry = 0
+        # url -> validators, content hash and parsed storage of the last response
+        self._page_cache: Dict[str, _CachedPage] = {}
+
         self.on_status_changed: Optional[Callable[[str, int], Any]] = None
         self._load_substitutions_lock = asyncio.Lock()
 
-    async def update(self, session: aiohttp.ClientSession) \
-            -> Tuple[bool, Optional[Dict[int, Dict[str, Union[str, List[str]]]]]]:
+    async def _get_token(self, session: aiohttp.ClientSession) -> str:
+        if self._token is not None and time.monotonic() < self._token_expiry:
+            return self._token
         # the following uses information from https://github.com/sn0wmanmj/pydsb (MIT license)
         _LOGGER.debug("[dsbmobile-crawler] Requesting token")
-        t1 = time.perf_counter_ns()
-        r = await session.get(self.BASE_URL +
-                              "/authid?bundleid=de.heinekingmedia.dsbmobile&appversion=35&osversion=22&pushid",
-                              params={"user": self._username, "password": self._password})
-        r.raise_for_status()
-        token = await r.json()
-        r.close()
+        async with session.get(self.BASE_URL +
+                               "/authid?bundleid=de.heinekingmedia.dsbmobile&appversion=35&osversion=22&pushid",
+                               params={"user": self._username, "password": self._password}) as r:
+            r.raise_for_status()
+            token = await r.json()
         if type(token) != str or len(token) != 36:
             raise ValueError(f"Unexpected response: {r.status} {token}")
-        _LOGGER.debug("[dsbmobile-crawler] Requesting substitution plan list")
-        r = await session.get(self.BASE_URL + "/dsbtimetables", params={"authid": token})
-        r.raise_for_status()
-        data = (await r.json())[0]
-        r.close()
+        self._token = token
+        self._token_expiry = time.monotonic() + self.TOKEN_LIFETIME
+        return token
+
+    async def _get_timetables(self, session: aiohttp.ClientSession) -> dict:
+        for retry in (False, True):
+            token = await self._get_token(session)
+            _LOGGER.debug("[dsbmobile-crawler] Requesting substitution plan list")
+            async with session.get(self.BASE_URL + "/dsbtimetables", params={"authid": token}) as r:
+                if r.status == 401 and not retry:
+                    _LOGGER.debug("[dsbmobile-crawler] Token was rejected, requesting a new one")
+                    self._token = None
+                    continue
+                r.raise_for_status()
+                return (await r.json())[0]
+
+    async def update(self, session: aiohttp.ClientSession) \
+            -> Tuple[bool, Optional[Dict[int, Dict[str, Union[str, List[str]]]]]]:
+        t1 = time.perf_counter_ns()
+        data = await self._get_timetables(session)
         status = data["Date"]
         status_datetime = datetime.datetime.strptime(status, "%d.%m.%Y %H:%M")
-        old_status = self._storage.status if self._storage is not None else None
+        old_status = self.last_version_id and self.last_version_id.get("status")
         t2 = time.perf_counter_ns()
         _LOGGER.debug(f"[dsbmobile-crawler] Got answer in {t2 - t1}ns, "
                       f"status is {repr(status)} (old: {repr(old_status)})")
         affected_groups = None
-        if status != old_status:
-            # status changed, load new data
+        if status != old_status or self._storage is None:
+            # status changed or this is the first update since the server started, load new data
             t1 = time.perf_counter_ns()
             if (res := await self._load_data(session, status, status_datetime, data)) is None:
                 # res is None when another request has already loaded new data
                 return False, None
             t2 = time.perf_counter_ns()
             last_site_num, affected_groups = res
+            if status == old_status:
+                affected_groups = None
+            self.last_version_id = {"status": status}
             changed_substitutions = True
             if self.on_status_changed:
                 await self.on_status_changed(status, last_site_num)
@@ -87,18 +125,43 @@ class DsbmobileSubstitutionCrawler(BaseSubstitutionCrawler):
             changed_substitutions = self._storage.remove_old_days()
         return changed_substitutions, affected_groups
 
+    async def _load_page(self, session: aiohttp.ClientSession, url: str, num: int, current_date: datetime.date) \
+            -> Optional[SubstitutionStorage]:
+        cached = self._page_cache.get(url)
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers[hdrs.IF_NONE_MATCH] = cached.etag
+            if cached.last_modified:
+                headers[hdrs.IF_MODIFIED_SINCE] = cached.last_modified
+        _LOGGER.debug(f"[dsbmobile-crawler] {num} Sending request")
+        async with session.get(url, headers=headers, timeout=self._timeout) as r:
+            _LOGGER.debug(f"[dsbmobile-crawler] {num} Got {r.status}")
+            if r.status == 304 and cached is not None:
+                return cached.storage
+            if r.status != 200:
+                return None
+            content = await r.read()
+            etag = r.headers.get(hdrs.ETAG)
+            last_modified = r.headers.get(hdrs.LAST_MODIFIED)
+        content_hash = hashlib.blake2b(content, digest_size=16).digest()
+        if cached is not None and cached.content_hash == content_hash:
+            _LOGGER.debug(f"[dsbmobile-crawler] {num} Content did not change")
+            storage = cached.storage
+        else:
+            _LOGGER.debug(f"[dsbmobile-crawler] {num} Parsing")
+            t1 = time.perf_counter_ns()
+            storage = SubstitutionStorage(None, None)
+            await self._parser_class(storage, current_date, AsyncBytesIOWrapper(content), num,
+                                     **self._parser_options).parse()
+            self._report_timing("parse", t1)
+            _LOGGER.debug(f"[dsbmobile-crawler] {num} Finished parsing")
+        self._page_cache[url] = _CachedPage(etag, last_modified, content_hash, storage)
+        return storage
+
     async def _load_data(self, session: aiohttp.ClientSession, status: str, status_datetime: datetime.datetime,
                          data: dict) -> \
             Optional[Tuple[Optional[int], Optional[Dict[int, Dict[str, Union[str, List[str]]]]]]]:
-        async def load_data(url, num):
-            _LOGGER.debug(f"[multipage-crawler] {num} Sending request")
-            r = await session.get(url, timeout=self._timeout)
-            _LOGGER.debug(f"[multipage-crawler] {num} Got {r.status}")
-            if r.status == 200:
-                _LOGGER.debug(f"[multipage-crawler] {num} Parsing")
-                await self._parser_class(storage, current_date, r.content, num, **self._parser_options).parse()
-                _LOGGER.debug(f"[multipage-crawler] {num} Finished parsing")
-
         if self._load_substitutions_lock.locked():
             _LOGGER.debug(f"[dsbmobile-crawler] Substitutions are already being loaded")
             async with self._load_substitutions_lock:
@@ -107,9 +170,9 @@ class DsbmobileSubstitutionCrawler(BaseSubstitutionCrawler):
         async with self._load_substitutions_lock:
             _LOGGER.debug("[dsbmobile-crawler] Loading substitution data...")
             current_date = datetime.date.today()
-            storage = SubstitutionStorage(status, status_datetime)
-            tasks = [asyncio.create_task(load_data(url, num))
-                     for num, url in enumerate((site["Detail"] for site in data["Childs"]), 1)]
+            urls = [site["Detail"] for site in data["Childs"]]
+            tasks = [asyncio.create_task(self._load_page(session, url, num, current_date))
+                     for num, url in enumerate(urls, 1)]
             try:
                 done, pending = await asyncio.wait_for(asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION),
                                                        timeout=2.0)
@@ -120,13 +183,30 @@ class DsbmobileSubstitutionCrawler(BaseSubstitutionCrawler):
                     if t.exception():
                         _LOGGER.exception("Exception while parsing", exc_info=t.exception())
                         has_exception = True
-                if has_exception:
+                if has_exception or pending:
                     raise ValueError("Could not complete parsing")
             except Exception as e:
                 _LOGGER.error("[dsbmobile-crawler] Got exception")
                 for t in tasks:
                     t.cancel()
                 raise e
-            new_affected_groups = storage.get_new_affected_groups(self._storage)
+
+            # forget pages which are no longer listed
+            for url in self._page_cache.keys() - set(urls):
+                del self._page_cache[url]
+
+            # merge the pages in their original order, without modifying the cached page storages
+            storage = SubstitutionStorage(status, status_datetime)
+            for t in tasks:
+                if (page_storage := t.result()) is None:
+                    continue
+                for day in page_storage.iter_days():
+                    if not storage.has_day(day.date):
+                        storage.add_day(SubstitutionDay(day.date, day.name, day.datestr, day.week))
+                    storage.get_day(day.date).merge(day)
+            # cached pages may contain days which are in the past by now
+            storage.remove_old_days()
+
+            new_affected_groups = self._get_new_affected_groups(storage)
             self._storage = storage
-            return len(data["Childs"]), new_affected_groups
+            return len(urls), new_affected_groups
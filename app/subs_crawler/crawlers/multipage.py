@@ -162,7 +162,9 @@ class MultiPageSubstitutionCrawler(BaseSubstitutionCrawler):
 
                 async def complete_parse(parser, request):
                     try:
+                        t1 = time.perf_counter_ns()
                         await parser.parse()
+                        self._report_timing("parse", t1)
                         _LOGGER.debug(f"[multipage-crawler] {num} Finished parsing")
                     finally:
                         if request is not None:
@@ -211,7 +213,7 @@ class MultiPageSubstitutionCrawler(BaseSubstitutionCrawler):
             if last_site_num is not None:
                 storage.status = status
                 storage.status_datetime = status_datetime
-                new_affected_groups = storage.get_new_affected_groups(self._storage)
+                new_affected_groups = self._get_new_affected_groups(storage)
                 self._storage = storage
                 return new_affected_groups, first_etag
         raise ValueError("Site loading limit (max_site_load_num={self._max_site_load_num}) reached")
@@ -95,6 +95,7 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
     }
 
     FORMAT_LOAD_INTERVAL = 5*60  # every 5 minutes
+    EXECUTOR_ROW_THRESHOLD = 500  # days with at least this many rows are parsed in a thread
 
     def __init__(self, last_version_id,
                  url: str, school_name: str, format_name: str, max_day_count: int = 5, reorder: List[int] = None, format_overrides: Dict[str, str] = None,
@@ -120,7 +121,6 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
                                               sock_connect=timeout_sock_connect)
 
         self._update_substitutions_lock = asyncio.Lock()
-        self._parse_data_lock = asyncio.Lock()
 
     async def update(self, session: aiohttp.ClientSession) \
             -> Tuple[bool, Optional[Dict[datetime.date, Dict[str, Union[str, List[str]]]]]]:
@@ -137,7 +137,7 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
 
             await self._load_format(session)
 
-            tasks = [asyncio.ensure_future(self._load_data(session, storage, today, i))
+            tasks = [asyncio.ensure_future(self._load_data(session, today, i))
                      for i in range(self._max_day_count)]
             try:
                 await asyncio.gather(*tasks)
@@ -146,7 +146,17 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
                     t.cancel()
                 raise e from None
 
-            storage.status = tasks[0].result()
+            # every task parses its day independently, the results are merged here
+            results = [t.result() for t in tasks]
+            for _, day in results:
+                if day is None:
+                    continue
+                if storage.has_day(day.date):
+                    storage.get_day(day.date).merge(day)
+                else:
+                    storage.add_day(day)
+
+            storage.status = results[0][0]
             storage.status_datetime = datetime.datetime.strptime(storage.status, "%d.%m.%Y %H:%M:%S")
 
             if storage.status == (self.last_version_id and self.last_version_id.get("status")):
@@ -161,13 +171,13 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
                 affected_groups = None
             else:
                 # substitutions have changed
-                affected_groups = storage.get_new_affected_groups(self._storage)
+                affected_groups = self._get_new_affected_groups(storage)
                 self.last_version_id = {"status": storage.status}
                 reload_required = True
                 self._storage = storage
 
-            if not all(t.result() == storage.status for t in tasks):
-                _LOGGER.warning(f"[webuntis-crawler] Different status for formats: {[t.result() for t in tasks]}")
+            if not all(status == storage.status for status, _ in results):
+                _LOGGER.warning(f"[webuntis-crawler] Different status for formats: {[status for status, _ in results]}")
                 reload_required = True
 
             t = time.perf_counter_ns() - t1
@@ -216,7 +226,8 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
             _LOGGER.debug(f"[webuntis-crawler] Updating format finished in {t}ns (~{t/1e9:.2f}s)")
             self._last_format_load_time = now
 
-    async def _load_data(self, session: aiohttp.ClientSession, storage: SubstitutionStorage, date: datetime.date, date_offset: int) -> str:
+    async def _load_data(self, session: aiohttp.ClientSession, date: datetime.date, date_offset: int) \
+            -> Tuple[str, Optional[SubstitutionDay]]:
         _LOGGER.debug(f"[webuntis-crawler] {date_offset} loading ...")
         t1 = time.perf_counter_ns()
         def log_finish(msg):
@@ -248,128 +259,134 @@ class WebuntisCrawler(BaseSubstitutionCrawler):
             date = datetime.datetime.strptime(str(data["date"]), "%Y%m%d").date()                        
             if date is None:
                 # date is None when there are no substitutions
-                return last_update
+                return last_update, None
             
             _LOGGER.debug(f"[webuntis-crawler] {date_offset} lastUpdate: {last_update!r}; date: {date}; name: {data['weekDay']}")
             if (self.last_version_id and self.last_version_id.get("status")) == last_update and self._storage is not None:
                 log_finish("no new update and storage exists")
-                return last_update
+                return last_update, None
 
             if date < datetime.date.today():
                 log_finish(f"day {data['date']!r} is in the past")
-                return last_update
+                return last_update, None
 
-            async with self._parse_data_lock:  # prevent race conditions in storage
-                if storage.has_day(date):
-                    day = storage.get_day(date)
-                else:
-                    day = SubstitutionDay(date=date, name=data["weekDay"], datestr=date.strftime("%d.%m.%Y"), week=None)
-                    storage.add_day(day)
-                
-                # SUBSTITUTIONS
-                for row in data["rows"]:
-                    subs_data = [_strip_html(s, None) for s in row["data"]]
-                    if self._lesson_column is not None:
-                        lesson_num = get_lesson_num(subs_data[self._lesson_column])
-                    else:
-                        lesson_num = None
-                    if self._class_columns:
-                        for column in self._class_columns:
-                            subs_data[column] = simplify_class_name(subs_data[column])
-                    if self._reorder:
-                        subs_data = tuple(subs_data[i] for i in self._reorder)
-                    substitution = Substitution(
-                        data=subs_data,
-                        lesson_num=lesson_num,
-                        name_is_class=self._group_name_is_class,
-                        affected_groups_columns=self._affected_groups_columns
-                    )
-                    group_id = (row["group"], False)  # not striked
-                    if (group := day.get_group(group_id)) is not None:
-                        group.substitutions.append(substitution)
-                    else:
-                        subs_group = SubstitutionGroup(group_id[0], group_id[1], [substitution], self._group_name_is_class)
-                        day.add_group(subs_group)
-
-
-                # ABSENCES
-                absent_classes = []
-                absent_teachers = []
-                for e in data["absentElements"]:
-                    """Examples for e:
-                    {
-                        "elementType": 2,
-                        "elementId": 4,
-                        "elementName": "ABC",
-                        "startUnit": null,
-                        "endUnit": null,
-                        "absences": [
-                        {
-                            "type": "ALL_DAY",
-                            "startTime": 0,
-                            "endTime": 2359,
-                            "isEvent": false,
-                            "startUnit": "0",
-                            "endUnit": "0"
-                        }
-                        ]
-                    },
-                    {
-                        "elementType": 2,
-                        "elementId": 8,
-                        "elementName": "DEF",
-                        "startUnit": null,
-                        "endUnit": null,
-                        "absences": [
-                        {
-                            "type": "FROM_TO",
-                            "startTime": 1030,
-                            "endTime": 1115,
-                            "isEvent": false,
-                            "startUnit": "4",
-                            "endUnit": "4"
-                        }
-                        ]
-                    }
-                    """
-                    try:
-                        absent_list = {1: absent_classes, 2: absent_teachers}[e["elementType"]]
-                    except:
-                        _LOGGER.error(f"[webuntis-crawler] absentElement has unknown elementType: {e!r}")
-                        continue
-                    # TODO: find out what e["startUnit"] and e["endUnit"] do
-                    name = e["elementName"]
-                    absences = []
-                    for absence in e["absences"]:
-                        if absence["type"] == "ALL_DAY":
-                            break
-                        elif absence["type"] == "FROM_TO":
-                            if absence["startUnit"] == absence["endUnit"]:
-                                absences.append(absence["startUnit"])
-                            else:
-                                absences.append(absence["startUnit"]+"-"+absence["endUnit"])
-                        else:
-                            _LOGGER.error(f"[webuntis-crawler] absentElement has unknown absence type: {e!r}")
-                    else:
-                        # loop did not break, no absence was ALL_DAY
-                        name += " (" + ", ".join(absences) + ")"
-                    absent_list.append(name)
-                if absent_classes:
-                    day.info.append(("Abwesende Klassen", ", ".join(absent_classes)))
-                if absent_teachers:
-                    day.info.append(("Abwesende Lehrkräfte", ", ".join(absent_teachers)))
-
-                # MESSAGES
-                for message in data["messageData"].pop("messages"):
-                    body = _strip_html(message["body"])
-                    if subject := message["subject"]:
-                        day.info.append((subject, body))
-                    else:
-                        day.news.append(body)
-                if data["messageData"]:
-                    _LOGGER.warning(f"[webuntis-crawler] {date_offset} More messageData found: {data['messageData']!r}")
-
-                return last_update
+            t_parse = time.perf_counter_ns()
+            if len(data["rows"]) >= self.EXECUTOR_ROW_THRESHOLD:
+                # parsing very large days would block the event loop for too long
+                day = await asyncio.get_running_loop().run_in_executor(None, self._parse_day, data, date, date_offset)
+            else:
+                day = self._parse_day(data, date, date_offset)
+            self._report_timing("parse", t_parse)
+            log_finish(f"parsed {len(data['rows'])} rows")
+            return last_update, day
         except Exception as e:
             _LOGGER.error(f"[webuntis-crawler] {date_offset} Failed to parse data: {data}")
             raise e from None
+
+    def _parse_day(self, data: dict, date: datetime.date, date_offset: int) -> SubstitutionDay:
+        day = SubstitutionDay(date=date, name=data["weekDay"], datestr=date.strftime("%d.%m.%Y"), week=None)
+
+        # SUBSTITUTIONS
+        for row in data["rows"]:
+            subs_data = [_strip_html(s, None) for s in row["data"]]
+            if self._lesson_column is not None:
+                lesson_num = get_lesson_num(subs_data[self._lesson_column])
+            else:
+                lesson_num = None
+            if self._class_columns:
+                for column in self._class_columns:
+                    subs_data[column] = simplify_class_name(subs_data[column])
+            if self._reorder:
+                subs_data = tuple(subs_data[i] for i in self._reorder)
+            substitution = Substitution(
+                data=subs_data,
+                lesson_num=lesson_num,
+                name_is_class=self._group_name_is_class,
+                affected_groups_columns=self._affected_groups_columns
+            )
+            group_id = (row["group"], False)  # not striked
+            if (group := day.get_group(group_id)) is not None:
+                group.substitutions.append(substitution)
+            else:
+                subs_group = SubstitutionGroup(group_id[0], group_id[1], [substitution], self._group_name_is_class)
+                day.add_group(subs_group)
+
+
+        # ABSENCES
+        absent_classes = []
+        absent_teachers = []
+        for e in data["absentElements"]:
+            """Examples for e:
+            {
+                "elementType": 2,
+                "elementId": 4,
+                "elementName": "ABC",
+                "startUnit": null,
+                "endUnit": null,
+                "absences": [
+                {
+                    "type": "ALL_DAY",
+                    "startTime": 0,
+                    "endTime": 2359,
+                    "isEvent": false,
+                    "startUnit": "0",
+                    "endUnit": "0"
+                }
+                ]
+            },
+            {
+                "elementType": 2,
+                "elementId": 8,
+                "elementName": "DEF",
+                "startUnit": null,
+                "endUnit": null,
+                "absences": [
+                {
+                    "type": "FROM_TO",
+                    "startTime": 1030,
+                    "endTime": 1115,
+                    "isEvent": false,
+                    "startUnit": "4",
+                    "endUnit": "4"
+                }
+                ]
+            }
+            """
+            try:
+                absent_list = {1: absent_classes, 2: absent_teachers}[e["elementType"]]
+            except:
+                _LOGGER.error(f"[webuntis-crawler] absentElement has unknown elementType: {e!r}")
+                continue
+            # TODO: find out what e["startUnit"] and e["endUnit"] do
+            name = e["elementName"]
+            absences = []
+            for absence in e["absences"]:
+                if absence["type"] == "ALL_DAY":
+                    break
+                elif absence["type"] == "FROM_TO":
+                    if absence["startUnit"] == absence["endUnit"]:
+                        absences.append(absence["startUnit"])
+                    else:
+                        absences.append(absence["startUnit"]+"-"+absence["endUnit"])
+                else:
+                    _LOGGER.error(f"[webuntis-crawler] absentElement has unknown absence type: {e!r}")
+            else:
+                # loop did not break, no absence was ALL_DAY
+                name += " (" + ", ".join(absences) + ")"
+            absent_list.append(name)
+        if absent_classes:
+            day.info.append(("Abwesende Klassen", ", ".join(absent_classes)))
+        if absent_teachers:
+            day.info.append(("Abwesende Lehrkräfte", ", ".join(absent_teachers)))
+
+        # MESSAGES
+        for message in data["messageData"].pop("messages"):
+            body = _strip_html(message["body"])
+            if subject := message["subject"]:
+                day.info.append((subject, body))
+            else:
+                day.news.append(body)
+        if data["messageData"]:
+            _LOGGER.warning(f"[webuntis-crawler] {date_offset} More messageData found: {data['messageData']!r}")
+
+        return day
@@ -0,0 +1,132 @@
+#  OpenVPlan
+#  Copyright (C) 2019-2021  Florian Rädiker
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import dataclasses
+import datetime
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from .storage import Substitution, SubstitutionDay, SubstitutionGroup, SubstitutionStorage
+
+
+@dataclasses.dataclass
+class GroupChanges:
+    group: Optional["SubstitutionGroup"]  # None if the group was removed
+    old_group: Optional["SubstitutionGroup"]  # None if the group is new
+    added: List["Substitution"]
+    removed: List["Substitution"]
+    unchanged: List["Substitution"]
+
+    @property
+    def id(self) -> Tuple[str, bool]:
+        return (self.group or self.old_group).id
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.removed)
+
+
+@dataclasses.dataclass
+class DayChanges:
+    day: Optional["SubstitutionDay"]  # None if the day was removed
+    old_day: Optional["SubstitutionDay"]  # None if the day is new
+    groups: Dict[Tuple[str, bool], GroupChanges]
+
+    @property
+    def date(self) -> datetime.date:
+        return (self.day or self.old_day).date
+
+    @property
+    def has_changes(self) -> bool:
+        return any(g.has_changes for g in self.groups.values())
+
+    def get_affected_groups(self) -> List[str]:
+        """ Return the names of all groups affected by new substitutions. """
+        # a dict keeps insertion order and makes checking for duplicates O(1)
+        affected_groups = {}
+        for changes in self.groups.values():
+            if changes.added:
+                affected_groups.update(dict.fromkeys(changes.group.affected_groups))
+        return list(affected_groups)
+
+
+@dataclasses.dataclass
+class StorageChanges:
+    days: Dict[datetime.date, DayChanges]
+
+    def iter_changed_days(self) -> Iterable[DayChanges]:
+        return (d for d in self.days.values() if d.has_changes)
+
+    def get_affected_groups(self) -> Dict[datetime.date, Dict[str, Union[str, List[str]]]]:
+        """
+        :return: {<date>: {"name": "<day name>", "groups": list of group names which are affected by new
+                  substitutions from this day}} for all days which are not removed and have new substitutions
+        """
+        affected_groups = {}
+        for changes in self.days.values():
+            if changes.day is not None and (groups := changes.get_affected_groups()):
+                affected_groups[changes.date] = {"name": changes.day.name, "groups": groups}
+        return affected_groups
+
+
+def diff_rows(new: Sequence["Substitution"], old: Sequence["Substitution"]) \
+        -> Tuple[List["Substitution"], List["Substitution"], List["Substitution"]]:
+    """ Return (added, removed, unchanged) rows. Duplicate rows are counted separately. """
+    old_counts = collections.Counter(old)
+    added = []
+    unchanged = []
+    for s in new:
+        if old_counts[s] > 0:
+            old_counts[s] -= 1
+            unchanged.append(s)
+        else:
+            added.append(s)
+    return added, list(old_counts.elements()), unchanged
+
+
+def diff_groups(new: Optional["SubstitutionGroup"], old: Optional["SubstitutionGroup"]) -> GroupChanges:
+    if old is None:
+        return GroupChanges(new, None, list(new.substitutions), [], [])
+    if new is None:
+        return GroupChanges(None, old, [], list(old.substitutions), [])
+    if new is old:
+        # shared between versions, see SubstitutionStorage.share_unchanged()
+        return GroupChanges(new, old, [], [], new.substitutions)
+    return GroupChanges(new, old, *diff_rows(new.substitutions, old.substitutions))
+
+
+def diff_days(new: Optional["SubstitutionDay"], old: Optional["SubstitutionDay"]) -> DayChanges:
+    groups = {}
+    if new is not None:
+        for group in new.groups:
+            groups[group.id] = diff_groups(group, old.get_group(group.id) if old is not None else None)
+    if old is not None:
+        for group in old.groups:
+            if new is None or new.get_group(group.id) is None:
+                groups[group.id] = diff_groups(None, group)
+    return DayChanges(new, old, groups)
+
+
+def diff_storages(new: "SubstitutionStorage", old: Optional["SubstitutionStorage"]) -> StorageChanges:
+    days = {}
+    for day in new.iter_days():
+        days[day.date] = diff_days(day, old.get_day(day.date) if old is not None and old.has_day(day.date) else None)
+    if old is not None:
+        for day in old.iter_days():
+            if not new.has_day(day.date):
+                days[day.date] = diff_days(None, day)
+    return StorageChanges(days)
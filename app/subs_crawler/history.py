@@ -0,0 +1,133 @@
+#  OpenVPlan
+#  Copyright (C) 2019-2021  Florian Rädiker
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .diff import StorageChanges
+from .storage import Substitution, SubstitutionGroup
+
+# {<date>: {<group id>: (<group>, <added rows>, <removed rows>)}}
+_Delta = Dict[datetime.date, Dict[Tuple[str, bool], Tuple[SubstitutionGroup, Tuple[Substitution, ...],
+                                                            Tuple[Substitution, ...]]]]
+
+
+def _day_info(day) -> tuple:
+    return day.name, day.datestr, day.week, day.news, day.info
+
+
+def _compact(changes: StorageChanges) -> Optional[_Delta]:
+    """ Return the changed rows, or None if something else than rows changed, e.g. a day's news. """
+    if any(d.day is not None and d.old_day is not None and _day_info(d.day) != _day_info(d.old_day)
+           for d in changes.days.values()):
+        return None
+    # only keep changed rows, unchanged ones are in the current storage anyway
+    delta = {}
+    for day_changes in changes.iter_changed_days():
+        delta[day_changes.date] = {
+            group_id: (group_changes.group or group_changes.old_group, tuple(group_changes.added),
+                       tuple(group_changes.removed))
+            for group_id, group_changes in day_changes.groups.items() if group_changes.has_changes
+        }
+    return delta
+
+
+class VersionHistory:
+    """
+    Keeps the changes of the last max_versions versions of a substitution plan in memory, so that clients only need
+    to load the rows that were added or removed since the version they know.
+
+    Versions are based on the current time, so they keep increasing after a restart. Versions from before a restart
+    are unknown to the new process, so clients knowing them receive the whole plan.
+    """
+
+    def __init__(self, max_versions: int):
+        self.version = self._next_version(0)
+        # (<version>, <changes from the previous version to this one>). The changes are None if they are not
+        # only about rows, clients have to load the whole plan then
+        self._deltas: Deque[Tuple[int, Optional[_Delta]]] = collections.deque(maxlen=max_versions)
+        # version before the first one in _deltas
+        self._base_version = self.version
+
+    @staticmethod
+    def _next_version(version: int) -> int:
+        return max(version + 1, time.time_ns() // 1_000_000)
+
+    def add(self, changes: Optional[StorageChanges]):
+        """ Add a new version. If changes is None, the changes are unknown and all previous versions are dropped. """
+        version = self._next_version(self.version)
+        if changes is None:
+            self._deltas.clear()
+            self._base_version = version
+        else:
+            if self._deltas.maxlen is not None and len(self._deltas) == self._deltas.maxlen:
+                # the oldest version is evicted by append()
+                self._base_version = self._deltas[0][0]
+            self._deltas.append((version, _compact(changes)))
+        self.version = version
+
+    def get_changes(self, since: int, selection: Optional[List[str]] = None) -> Optional[List[dict]]:
+        """
+        Return the rows added and removed since version since, only including rows for selection.
+
+        :return: None if since is not known (anymore) or if more than rows changed since then
+        """
+        if since == self.version:
+            return []
+        if since == self._base_version:
+            start = 0
+        else:
+            for start, (version, _) in enumerate(self._deltas, 1):
+                if version == since:
+                    break
+            else:
+                return None
+
+        # merge all deltas, a row that was added and removed again cancels out
+        counts: Dict[Tuple[datetime.date, Tuple[str, bool]], collections.Counter] = {}
+        groups: Dict[Tuple[datetime.date, Tuple[str, bool]], SubstitutionGroup] = {}
+        for _, delta in list(self._deltas)[start:]:
+            if delta is None:
+                return None
+            for date, day_delta in delta.items():
+                for group_id, (group, added, removed) in day_delta.items():
+                    key = (date, group_id)
+                    groups[key] = group
+                    c = counts.setdefault(key, collections.Counter())
+                    c.update(added)
+                    c.subtract(removed)
+
+        changes = []
+        for key, c in counts.items():
+            group = groups[key]
+            group_selected = group.is_selected(selection)
+            added = []
+            removed = []
+            for substitution, count in c.items():
+                if count and (group_selected or substitution.is_selected(selection)):
+                    (added if count > 0 else removed).extend([substitution] * abs(count))
+            if added or removed:
+                data = {"date": key[0].isoformat(), "name": group.name}
+                if group.striked:
+                    data["striked"] = group.striked
+                data["added"] = [s.to_data() for s in added]
+                # clients mark the rows with their lesson, e.g. to grey out past lessons
+                data["added_lessons"] = [s.lesson_num for s in added]
+                data["removed"] = [s.to_data() for s in removed]
+                changes.append(data)
+        return changes
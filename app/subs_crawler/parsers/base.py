@@ -25,6 +25,9 @@ from ..storage import SubstitutionStorage
 
 
 class AsyncBytesIOWrapper(io.BytesIO):
+    async def read(self, size=-1):
+        return super().read(size)
+
     async def readline(self, **kwargs):
         return super().readline(**kwargs)
 
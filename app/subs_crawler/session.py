@@ -0,0 +1,157 @@
+#  OpenVPlan
+#  Copyright (C) 2019-2021  Florian Rädiker
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+from multidict import CIMultiDictProxy
+from yarl import URL
+
+from .parsers.base import AsyncBytesIOWrapper
+
+_LOGGER = logging.getLogger("openvplan")
+
+
+class CachedResponse:
+    """ A fully read response which can be shared between crawlers. Mimics the parts of aiohttp.ClientResponse
+    used by the crawlers. """
+
+    def __init__(self, request_info: aiohttp.RequestInfo, status: int, reason: Optional[str],
+                 headers: CIMultiDictProxy, body: bytes, charset: Optional[str]):
+        self.request_info = request_info
+        self.method = request_info.method
+        self.url = request_info.url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = body
+        self._charset = charset
+
+    @property
+    def content(self) -> AsyncBytesIOWrapper:
+        return AsyncBytesIOWrapper(self._body)
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = None) -> str:
+        return self._body.decode(encoding or self._charset or "utf-8")
+
+    async def json(self, encoding: str = None) -> Any:
+        return json.loads(await self.text(encoding))
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(self.request_info, (), status=self.status, message=self.reason,
+                                              headers=self.headers)
+
+    def close(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class _RequestContextManager:
+    # like aiohttp's _RequestContextManager, can be awaited or used with "async with"
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> CachedResponse:
+        return await self._coro
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class CoalescingClientSession:
+    """
+    Wraps an aiohttp.ClientSession for use by crawlers. Identical requests (same method, URL, query, headers and
+    body) which are made at the same time are only sent once, and their successful responses are shared for
+    response_ttl seconds. This way, several plans using the same upstream server only cause one set of requests.
+
+    Besides these, only allow_redirects and timeout are supported. The timeout of the crawler which sends a shared
+    request applies to all crawlers waiting for it.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, response_ttl: float):
+        self._session = session
+        self._response_ttl = response_ttl
+        self._in_flight: Dict[Tuple, asyncio.Future] = {}
+        self._responses: Dict[Tuple, Tuple[float, CachedResponse]] = {}
+
+    @staticmethod
+    def _get_key(method: str, url, params, headers, data, json_data, kwargs: Dict[str, Any]) -> Tuple:
+        if data is not None and not isinstance(data, (bytes, str)):
+            raise TypeError("Only bytes or str data is supported")
+        if unsupported := kwargs.keys() - {"allow_redirects", "timeout"}:
+            raise TypeError(f"Unsupported arguments for a shared request: {', '.join(sorted(unsupported))}")
+        return (method.upper(), str(URL(url).update_query(params) if params else URL(url)),
+                tuple(sorted((headers or {}).items())),
+                data, json.dumps(json_data, sort_keys=True) if json_data is not None else None,
+                kwargs.get("allow_redirects", True))
+
+    def _remove_expired(self, now: float):
+        for key in [key for key, (expiry, _) in self._responses.items() if expiry <= now]:
+            del self._responses[key]
+
+    async def _request(self, method: str, url, *, params=None, headers=None, data=None, json=None, **kwargs) \
+            -> CachedResponse:
+        key = self._get_key(method, url, params, headers, data, json, kwargs)
+        now = time.monotonic()
+        self._remove_expired(now)
+        if (cached := self._responses.get(key)) is not None:
+            _LOGGER.debug(f"Using shared response for {method} {url}")
+            return cached[1]
+        if (future := self._in_flight.get(key)) is None:
+            async def load():
+                try:
+                    async with self._session.request(method, url, params=params, headers=headers, data=data,
+                                                     json=json, **kwargs) as r:
+                        request_info = aiohttp.RequestInfo(r.url, r.method, r.request_info.headers, r.url)
+                        response = CachedResponse(request_info, r.status, r.reason, r.headers, await r.read(),
+                                                  r.charset)
+                    # error responses are only shared with requests made at the same time, the next request might
+                    # succeed
+                    if response.status < 400:
+                        self._responses[key] = (time.monotonic() + self._response_ttl, response)
+                    return response
+                finally:
+                    del self._in_flight[key]
+
+            # the request must not be cancelled when the first crawler waiting for it is cancelled
+            future = self._in_flight[key] = asyncio.ensure_future(load())
+            # retrieve the exception in case nobody is waiting for the request anymore
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        else:
+            _LOGGER.debug(f"Joining in-flight request {method} {url}")
+        return await asyncio.shield(future)
+
+    def request(self, method: str, url, **kwargs) -> _RequestContextManager:
+        return _RequestContextManager(self._request(method, url, **kwargs))
+
+    def get(self, url, **kwargs) -> _RequestContextManager:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> _RequestContextManager:
+        return self.request("POST", url, **kwargs)
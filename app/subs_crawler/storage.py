@@ -16,10 +16,14 @@
 
 import dataclasses
 import datetime
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+import sys
+import threading
+import weakref
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
 
 from sortedcontainers import SortedDict, SortedKeysView, SortedList
 
+from .diff import StorageChanges, diff_days, diff_storages
 from .utils import split_class_name, parse_affected_groups
 
 
@@ -42,25 +46,30 @@ class SubstitutionStorage:
     def iter_days(self):
         yield from self._days.values()
 
+    def share_unchanged(self, old_storage: Optional["SubstitutionStorage"]):
+        """
+        Replace days, groups and substitutions which are equal to the ones in old_storage with the objects from
+        old_storage, so that unchanged parts of consecutive versions are the same objects.
+        """
+        if old_storage is None:
+            return
+        for date, day in list(self._days.items()):
+            if old_storage.has_day(date):
+                old_day = old_storage.get_day(date)
+                if day.share_unchanged(old_day):
+                    self._days[date] = old_day
+
+    def get_changes(self, old_storage: Optional["SubstitutionStorage"]) -> StorageChanges:
+        """ Return the added, removed and unchanged substitutions per day and group compared to old_storage. """
+        return diff_storages(self, old_storage)
+
     def get_new_affected_groups(self, old_storage: Optional["SubstitutionStorage"]) \
-            -> Dict[int, Dict[str, Union[str, List[str]]]]:
+            -> Dict[datetime.date, Dict[str, Union[str, List[str]]]]:
         """
-        :return: {<day expiry time>:
+        :return: {<date>:
         {"name": "<day name">, "groups": list of group names which are affected by new substitutions from this day}}
         """
-        if old_storage is None:
-            return {day.date: {"name": day.name, "groups": day.get_new_affected_groups(None)}
-                    for day in self._days.values()}
-        affected_groups = {}
-        for day in self._days.values():
-            try:
-                old_day = old_storage.get_day(day.date)
-            except KeyError:
-                affected_groups[day.date] = {"name": day.name, "groups": day.get_new_affected_groups(None)}
-            else:
-                if g := day.get_new_affected_groups(old_day):
-                    affected_groups[day.date] = {"name": day.name, "groups": g}
-        return affected_groups
+        return self.get_changes(old_storage).get_affected_groups()
 
     def remove_old_days(self) -> bool:
         current_date = datetime.date.today()
@@ -75,6 +84,20 @@ class SubstitutionStorage:
     def to_data(self, selection=None):
         return {"status": self.status, "days": [d.to_data(selection) for d in self._days.values()]}
 
+    def to_snapshot(self) -> dict:
+        """ Return a JSON-serializable representation of this storage which can be restored with from_snapshot(). """
+        return {"status": self.status,
+                "status_datetime": self.status_datetime.isoformat() if self.status_datetime else None,
+                "days": [d.to_snapshot() for d in self._days.values()]}
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "SubstitutionStorage":
+        storage = cls(snapshot["status"], snapshot["status_datetime"] and
+                      datetime.datetime.fromisoformat(snapshot["status_datetime"]))
+        for day in snapshot["days"]:
+            storage.add_day(SubstitutionDay.from_snapshot(day))
+        return storage
+
 
 @dataclasses.dataclass
 class SubstitutionDay:
@@ -95,6 +118,42 @@ class SubstitutionDay:
     def get_group(self, group_id: Tuple[str, bool], default=None):
         return self._id2group.get(group_id, default)
 
+    def share_unchanged(self, old_day: "SubstitutionDay") -> bool:
+        """
+        Replace groups and substitutions which are equal to the ones in old_day with the objects from old_day.
+
+        :return: whether this day is equal to old_day, in which case old_day can be used instead of it
+        """
+        is_equal = len(self._id2group) == len(old_day._id2group)
+        groups_replaced = False
+        for group_id, group in self._id2group.items():
+            old_group = old_day.get_group(group_id)
+            if old_group is None:
+                is_equal = False
+            elif group.substitutions == old_group.substitutions:
+                self._id2group[group_id] = old_group
+                groups_replaced = True
+            else:
+                is_equal = False
+                old_substitutions = {s: s for s in old_group.substitutions}
+                group.substitutions[:] = [old_substitutions.get(s, s) for s in group.substitutions]
+        if groups_replaced:
+            self._groups = SortedList(self._id2group.values())
+        return (is_equal and self.name == old_day.name and self.datestr == old_day.datestr and
+                self.week == old_day.week and self.news == old_day.news and self.info == old_day.info)
+
+    def merge(self, other: "SubstitutionDay"):
+        """ Add the groups, news and info of another day with the same date to this day. """
+        assert other.date == self.date
+        for group in other.groups:
+            if (existing := self.get_group(group.id)) is not None:
+                existing.substitutions.extend(group.substitutions)
+            else:
+                # copy the group so that later merges don't modify the other day
+                self.add_group(group.copy())
+        self.news.extend(other.news)
+        self.info.extend(other.info)
+
     def __lt__(self, other: "SubstitutionDay"):
         return self.date < other.date
 
@@ -103,19 +162,21 @@ class SubstitutionDay:
         return self._groups
 
     def get_new_affected_groups(self, old_day: Optional["SubstitutionDay"]) -> List[str]:
-        res = []
-        if old_day is None:
-            for g in self._groups:
-                for affected_group in g.affected_groups:
-                    if affected_group not in res:
-                        res.append(affected_group)
-            return res
-        for g in self._groups:
-            if g.has_new_substitutions(old_day.get_group(g.id)):
-                for affected_group in g.affected_groups:
-                    if affected_group not in res:
-                        res.append(affected_group)
-        return res
+        return diff_days(self, old_day).get_affected_groups()
+
+    def to_snapshot(self) -> list:
+        return [self.date.isoformat(), self.name, self.datestr, self.week, self.news, self.info,
+                [g.to_snapshot() for g in self._groups]]
+
+    @classmethod
+    def from_snapshot(cls, snapshot: list) -> "SubstitutionDay":
+        date, name, datestr, week, news, info, groups = snapshot
+        day = cls(datetime.date.fromisoformat(date), name, datestr, week)
+        day.news.extend(news)
+        day.info.extend(tuple(i) for i in info)
+        for group in groups:
+            day.add_group(SubstitutionGroup.from_snapshot(group))
+        return day
 
     def to_data(self, selection=None):
         return {key: value for key, value in (("date", self.date),
@@ -124,91 +185,187 @@ class SubstitutionDay:
                                               ("week", self.week),
                                               ("news", self.news),
                                               ("info", self.info),
-                                              ("groups", [g.to_data() for g in self.iter_groups(selection)])
+                                              ("groups", [g.to_data(selection) for g in self._groups
+                                                          if g.get_selected_substitutions(selection)])
                                               ) if value is not None}
 
 
-@dataclasses.dataclass(frozen=True)
+class _AffectedGroups(frozenset):
+    # unlike frozenset itself, a subclass can be weakly referenced
+    pass
+
+
+# identical sets of affected groups are shared between all substitutions and groups. They are only kept as long as
+# a substitution or group uses them
+_affected_groups_sets: "weakref.WeakValueDictionary[FrozenSet[str], _AffectedGroups]" = weakref.WeakValueDictionary()
+# parsers may run in executor threads
+_affected_groups_lock = threading.Lock()
+
+
+def _intern_affected_groups(affected_groups: Iterable[str]) -> FrozenSet[str]:
+    # the key must not be the value itself, it would keep the value alive
+    key = frozenset(sys.intern(g) for g in affected_groups)
+    with _affected_groups_lock:
+        if (value := _affected_groups_sets.get(key)) is None:
+            value = _affected_groups_sets[key] = _AffectedGroups(key)
+        return value
+
+
 class SubstitutionGroup:
+    # SubstitutionGroup and Substitution exist thousands of times, so they use __slots__ instead of a __dict__
+    __slots__ = ("name", "striked", "substitutions", "id", "_split_name", "affected_groups", "selection_name")
+
     name: str
-    _split_name: Tuple[int, str, bool] = dataclasses.field(init=False, compare=False)
     striked: bool
-    substitutions: List["Substitution"] = dataclasses.field(default_factory=list)
-    id: Tuple[str, bool] = dataclasses.field(init=False, compare=False)
-    affected_groups: Optional[List[str]] = dataclasses.field(init=False, compare=False)
-    selection_name: Optional[str] = dataclasses.field(init=False, compare=False)
-
-    name_is_class: dataclasses.InitVar[bool] = True
-
-    def __post_init__(self, name_is_class):
-        object.__setattr__(self, "id", (self.name, self.striked))
-        number_part, letters_part = split_class_name(self.name)
-        object.__setattr__(self, "_split_name", (int(number_part) if number_part else 0, letters_part, self.striked))
+    substitutions: List["Substitution"]
+    id: Tuple[str, bool]
+    _split_name: Tuple[int, str, bool]
+    affected_groups: FrozenSet[str]
+    selection_name: Optional[str]
+
+    def __init__(self, name: str, striked: bool, substitutions: List["Substitution"] = None,
+                 name_is_class: bool = True):
         if name_is_class:
-            affected_groups, selection_name = parse_affected_groups(self.name)
-            object.__setattr__(self, "affected_groups", affected_groups)
-            object.__setattr__(self, "selection_name", selection_name)
+            affected_groups, selection_name = parse_affected_groups(name)
         else:
-            object.__setattr__(self, "affected_groups", {self.name})
-            object.__setattr__(self, "selection_name", self.name)
+            affected_groups, selection_name = (name,), name
+        self._set_fields(name, striked, substitutions if substitutions is not None else [], affected_groups,
+                         selection_name)
+
+    def _set_fields(self, name: str, striked: bool, substitutions: List["Substitution"],
+                    affected_groups: Iterable[str], selection_name: Optional[str]):
+        name = sys.intern(name)
+        set_ = object.__setattr__
+        set_(self, "name", name)
+        set_(self, "striked", striked)
+        set_(self, "substitutions", substitutions)
+        set_(self, "id", (name, striked))
+        number_part, letters_part = split_class_name(name)
+        set_(self, "_split_name", (int(number_part) if number_part else 0, letters_part, striked))
+        set_(self, "affected_groups", _intern_affected_groups(affected_groups))
+        set_(self, "selection_name", selection_name)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"cannot assign to field {key!r}")
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.name, self.striked, self.substitutions) == (other.name, other.striked, other.substitutions)
+
+    __hash__ = None  # substitutions is mutable
+
+    def __repr__(self):
+        return f"SubstitutionGroup(name={self.name!r}, striked={self.striked!r}, substitutions={self.substitutions!r})"
 
     def __lt__(self, other: "SubstitutionGroup"):
         if not self.name:
             return False  # sort substitutions without a class last
         return self._split_name.__lt__(other._split_name)
-    
-    def get_selected_substitutions(self, selection=None):
-        if (
+
+    def copy(self) -> "SubstitutionGroup":
+        group = SubstitutionGroup.__new__(SubstitutionGroup)
+        for attr in self.__slots__:
+            object.__setattr__(group, attr, getattr(self, attr))
+        object.__setattr__(group, "substitutions", list(self.substitutions))
+        return group
+
+    def is_selected(self, selection=None) -> bool:
+        """ Whether all substitutions of this group are selected. """
+        return (
             not selection or
             not self.name  # always include substitutions without a class
             or any(s in self.affected_groups for s in selection)
-        ):
+        )
+
+    def get_selected_substitutions(self, selection=None):
+        if self.is_selected(selection):
             return self.substitutions
         return [subs for subs in self.substitutions if subs.is_selected(selection)]
 
     def get_html_name(self):
         return ("<strike>" + self.name + "</strike>") if self.striked else self.name
 
-    def has_new_substitutions(self, old_group: Optional["SubstitutionGroup"]):
-        if old_group is None:
-            return True
-        return any(s not in old_group.substitutions for s in self.substitutions)
+    def to_snapshot(self) -> list:
+        return [self.name, self.striked, sorted(self.affected_groups), self.selection_name,
+                [s.to_snapshot() for s in self.substitutions]]
 
-    def to_data(self):
+    @classmethod
+    def from_snapshot(cls, snapshot: list) -> "SubstitutionGroup":
+        name, striked, affected_groups, selection_name, substitutions = snapshot
+        group = cls.__new__(cls)
+        group._set_fields(name, striked, [Substitution.from_snapshot(s) for s in substitutions], affected_groups,
+                          selection_name)
+        return group
+
+    def to_data(self, selection=None):
         data = {"name": self.name}
         if self.striked:
             data["striked"] = self.striked
-        data["substitutions"] = [s.to_data() for s in self.substitutions]
+        data["substitutions"] = [s.to_data() for s in self.get_selected_substitutions(selection)]
         return data
 
 
-@dataclasses.dataclass(frozen=True)
 class Substitution:
-    data: Tuple[str, ...]
-    lesson_num: Optional[int] = dataclasses.field(default=None)
-
-    affected_groups: Optional[List[str]] = dataclasses.field(init=False, compare=False)
+    __slots__ = ("data", "lesson_num", "affected_groups", "_hash")
 
-    name_is_class: dataclasses.InitVar[bool] = True
-    affected_groups_columns: dataclasses.InitVar[List[int]] = []
+    data: Tuple[str, ...]
+    lesson_num: Optional[int]
+    affected_groups: Optional[FrozenSet[str]]
 
-    def __post_init__(self, name_is_class, affected_groups_columns):
+    def __init__(self, data: Iterable[str], lesson_num: Optional[int] = None, name_is_class: bool = True,
+                 affected_groups_columns: List[int] = None):
+        # the same teachers, rooms, subjects etc. appear in lots of rows
+        data = tuple(map(sys.intern, data))
         if affected_groups_columns:
             affected_groups = set()
             for column in affected_groups_columns:
-                content = self.data[column-1]
+                content = data[column-1]
                 if name_is_class:
                     affected_groups.update(parse_affected_groups(content)[0])
                 else:
                     affected_groups.add(content)
         else:
             affected_groups = None
-        object.__setattr__(self, "affected_groups", affected_groups)
+        self._set_fields(data, lesson_num, affected_groups)
+
+    def _set_fields(self, data: Tuple[str, ...], lesson_num: Optional[int], affected_groups: Optional[Iterable[str]]):
+        set_ = object.__setattr__
+        set_(self, "data", data)
+        set_(self, "lesson_num", lesson_num)
+        set_(self, "affected_groups", _intern_affected_groups(affected_groups) if affected_groups is not None else None)
+        # substitutions are hashed a lot when comparing versions
+        set_(self, "_hash", hash((data, lesson_num)))
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"cannot assign to field {key!r}")
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._hash == other._hash and self.data == other.data and self.lesson_num == other.lesson_num
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"Substitution(data={self.data!r}, lesson_num={self.lesson_num!r})"
 
     def is_selected(self, selection=None):
         if self.affected_groups is None:
             return False
         return any(s in self.affected_groups for s in selection)
 
+    def to_snapshot(self) -> list:
+        return [self.data, self.lesson_num,
+                sorted(self.affected_groups) if self.affected_groups is not None else None]
+
+    @classmethod
+    def from_snapshot(cls, snapshot: list) -> "Substitution":
+        data, lesson_num, affected_groups = snapshot
+        substitution = cls.__new__(cls)
+        substitution._set_fields(tuple(map(sys.intern, data)), lesson_num, affected_groups)
+        return substitution
+
     def to_data(self):
         return self.data
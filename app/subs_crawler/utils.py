@@ -14,15 +14,86 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
 import datetime
+import functools
 import re
+import threading
 import time
-from functools import lru_cache
-from typing import List, Tuple, Optional, Set
+from typing import Callable, FrozenSet, List, NamedTuple, Tuple, Optional, TypeVar
+
+_T = TypeVar("_T", bound=Callable)
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class BoundedCache:
+    """
+    A LRU cache shared by several functions. Results of all functions count towards maxsize, so the size can be
+    chosen according to the number of distinct class names and lessons of all plans.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data: "collections.OrderedDict[tuple, object]" = collections.OrderedDict()
+        # parsers may run in executor threads
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def set_maxsize(self, maxsize: int):
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses, self._maxsize, len(self._data))
+
+    def cache_clear(self):
+        with self._lock:
+            self._data.clear()
+            self._hits = self._misses = 0
+
+    def memoize(self, func: _T) -> _T:
+        """ Decorator for functions with one hashable argument and an immutable result. """
+        data = self._data
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            key = (func, arg)
+            try:
+                result = data[key]
+            except KeyError:
+                result = func(arg)
+                with self._lock:
+                    self._misses += 1
+                    data[key] = result
+                    if len(data) > self._maxsize:
+                        data.popitem(last=False)
+                return result
+            # hits don't need the lock, the key may only have been evicted in the meantime
+            try:
+                data.move_to_end(key)
+            except KeyError:
+                pass
+            self._hits += 1
+            return result
+        return wrapper
+
+
+# class names, lessons etc. are the same in all rows and all crawls, see Settings.class_name_cache_size
+CLASS_NAME_CACHE = BoundedCache(4096)
 
 
 REGEX_GROUP_NAME = re.compile(r"^(\()?(\d+)(.*)(?(1)\)|)")
 
+@CLASS_NAME_CACHE.memoize
 def split_class_name(class_name: str) -> Tuple[str, str]:
     matches = REGEX_GROUP_NAME.fullmatch(class_name)
     if matches:
@@ -40,10 +111,11 @@ REGEX_CLASS = re.compile(r"^(\()?"
                          r"(\d+)([A-Za-z]*)"
                          r"(?(1)\)|)")
 
-def parse_affected_groups(class_name: str) -> Tuple[Set[str], Optional[str]]:
+@CLASS_NAME_CACHE.memoize
+def parse_affected_groups(class_name: str) -> Tuple[FrozenSet[str], Optional[str]]:
     name = class_name.upper().strip()
     if not name:
-        return set(), None
+        return frozenset(), None
     affected_groups = set()
     count = 0
     while name:
@@ -51,8 +123,8 @@ def parse_affected_groups(class_name: str) -> Tuple[Set[str], Optional[str]]:
         if match is None:
             if all(not c.isdigit() for c in name):
                 # names without any digits can also be selected
-                return {strip_par(name)}, strip_par(class_name)
-            return {strip_par(name)}, None
+                return frozenset((strip_par(name),)), strip_par(class_name)
+            return frozenset((strip_par(name),)), None
         count += 1
         _, digits, letters = match.groups()
         affected_groups.add(digits)
@@ -61,7 +133,7 @@ def parse_affected_groups(class_name: str) -> Tuple[Set[str], Optional[str]]:
         for letter in letters:
             affected_groups.add(digits + letter)
         name = name[match.span()[1]:]
-    return affected_groups, strip_par(class_name) if count == 1 else None
+    return frozenset(affected_groups), strip_par(class_name) if count == 1 else None
 
 
 def split_selection(selection: str) -> Optional[List[str]]:
@@ -74,6 +146,7 @@ def split_selection(selection: str) -> Optional[List[str]]:
     return selected_groups
 
 
+@CLASS_NAME_CACHE.memoize
 def simplify_class_name(class_name: str):
     # simplify classes such as "11A, 11B, 11C, 11D"
     if "," in class_name:
@@ -93,7 +166,7 @@ def simplify_class_name(class_name: str):
 
 REGEX_NUMBERS = re.compile(r"\d*")
 
-@lru_cache(maxsize=128)
+@CLASS_NAME_CACHE.memoize
 def get_lesson_num(lesson_string):
     try:
         return max(int(num.group(0)) for num in REGEX_NUMBERS.finditer(lesson_string) if num.group(0) != "")
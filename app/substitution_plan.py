@@ -19,25 +19,27 @@ import crypt
 import datetime
 import hmac
 import json
-import sqlite3
+import os
 from tabnanny import check
 import time
-from _weakrefset import WeakSet
+from weakref import WeakKeyDictionary
 from email.utils import formatdate
 from functools import partial
-from typing import Iterable, MutableSet, Optional, Tuple, Callable, Awaitable, List
+from typing import Dict, MutableMapping, Optional, Tuple, Callable, Awaitable, List, Union
 from urllib.parse import urlparse
 
-import aiocron
-import pywebpush
 import yarl
-from aiohttp import web, WSMessage, WSMsgType
+from aiohttp import web, hdrs, WSMessage, WSMsgType
 from aiojobs.aiohttp import get_scheduler_from_app
 
-from . import log_helper
-from .db import hash_endpoint, SubstitutionPlanDB
+from . import log_helper, metrics
+from .db import hash_endpoint, PushMessage, SubstitutionPlanDB
+from .push import DEFAULT_TTL, get_topic, PushResult
+from .scheduler import AdaptivePollingScheduler
 from .settings import Settings
 from .subs_crawler.crawlers.base import BaseSubstitutionCrawler
+from .subs_crawler.diff import StorageChanges
+from .subs_crawler.history import VersionHistory
 from .subs_crawler.utils import split_selection
 
 # Time when a "<plan-name>-selection" cookie expires. This is on 29th July, as on this date, summer holidays in Lower
@@ -50,22 +52,44 @@ SELECTION_COOKIE_EXPIRE = formatdate(time.mktime(
 DELETE_COOKIE_EXPIRE = formatdate(0)
 
 
-# Intercept pywebpush.WebPusher.as_curl() call in pywebpush.WebPusher.send() so that request can be made with aiohttp.
-# A call to pywebpush.webpush(..., curl=True) will now return (endpoint, data, headers).
-pywebpush.WebPusher.as_curl = lambda s, e, d, h: (e, d, h)
-
-
 class SubstitutionPlan:
-    def __init__(self, app: web.Application, plan_id: str, crawler: BaseSubstitutionCrawler, render_func: Callable[..., Awaitable[str]], subs_options: dict):
+    def __init__(self, app: web.Application, plan_id: str, crawler: BaseSubstitutionCrawler, render_func: Callable[..., Awaitable[str]], subs_options: dict,
+                 snapshot_path: Optional[str] = None, push_debounce: float = 0):
         self._plan_id = plan_id
         self._crawler = crawler
+        self._snapshot_path = snapshot_path
+        self._snapshot_lock = asyncio.Lock()
         self._render_func = partial(render_func, "substitution-plan.min.html",
                                     app=app, plan_id=plan_id, subs_options=subs_options)
         self._render_login_func = partial(render_func, "login.min.html",
                                           app=app, plan_id=plan_id, subs_options=subs_options)
 
         self._index_site = None
-        self._websockets: MutableSet[web.WebSocketResponse] = WeakSet()
+        # WebSocket connection -> (<selection>, <version of the plan shown by the client>), or None for clients
+        # which did not register
+        self._websockets: MutableMapping[web.WebSocketResponse, Optional[Tuple[Optional[Tuple[str, ...]], int]]] = \
+            WeakKeyDictionary()
+
+        settings: Settings = app["settings"]
+        self._scheduler = AdaptivePollingScheduler(settings.polling_min_interval, settings.polling_max_interval,
+                                                   settings.polling_jitter)
+
+        self._push_topic = get_topic(plan_id)
+        self._push_debounce = push_debounce
+        # affected groups of updates waiting for the debounce window to close, None if there is no window open
+        self._debounced_affected_groups: Optional[Dict[datetime.date, dict]] = None
+
+        self._history = VersionHistory(settings.version_history_size)
+        # storage of the current version in self._history
+        self._history_storage = None
+        self._pending_changes: Optional[StorageChanges] = None
+
+        def on_changes(changes: StorageChanges):
+            self._pending_changes = changes
+        self._crawler.on_changes = on_changes
+        self._crawler.on_timing = lambda stage, t: metrics.CRAWLER_STAGE_DURATION.observe(t / 1e9, plan=plan_id,
+                                                                                          stage=stage)
+        metrics.OPEN_WEBSOCKETS.set_function(lambda: len(self._websockets), plan=plan_id)
 
         template_options = app["settings"].template_options
 
@@ -85,13 +109,46 @@ class SubstitutionPlan:
         else:
             self.use_auth = False
 
-    def on_db_init(self, app: web.Application):
-        self._crawler.last_version_id = app["db"].get_substitutions_version_id(self._plan_id)
+    async def on_db_init(self, app: web.Application):
+        self._crawler.last_version_id = await app["db"].get_substitutions_version_id(self._plan_id)
         log_helper.PLAN_NAME_CONTEXTVAR.set(self._plan_id)
         app["logger"].debug(f"Last substitution version id is: {self._crawler.last_version_id!r}")
+        self._scheduler.set_history(await app["db"].get_status_changes(self._plan_id))
+        self._load_snapshot(app)
+        self._history_storage = self._crawler.storage
         log_helper.PLAN_NAME_CONTEXTVAR.set(None)
 
-    def create_app(self, background_updates: List[str]) -> web.Application:
+    def _load_snapshot(self, app: web.Application):
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return
+        t1 = time.perf_counter_ns()
+        # noinspection PyBroadException
+        try:
+            with open(self._snapshot_path, "rb") as f:
+                loaded = self._crawler.load_snapshot(f.read())
+        except Exception:
+            app["logger"].exception(f"Could not load snapshot {self._snapshot_path}")
+            return
+        if loaded:
+            app["logger"].info(f"Loaded substitutions from snapshot in {(time.perf_counter_ns() - t1) / 1e6:.1f}ms")
+
+    async def _save_snapshot(self, app: web.Application, snapshot: bytes):
+        def write():
+            tmp_path = self._snapshot_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(snapshot)
+            # atomically replace the old snapshot, so that a crash never leaves a half-written file
+            os.replace(tmp_path, self._snapshot_path)
+
+        # noinspection PyBroadException
+        try:
+            async with self._snapshot_lock:
+                await asyncio.get_running_loop().run_in_executor(None, write)
+            app["logger"].debug(f"Saved snapshot ({len(snapshot)} bytes)")
+        except Exception:
+            app["logger"].exception(f"Could not save snapshot {self._snapshot_path}")
+
+    def create_app(self) -> web.Application:
         app = web.Application()
         app.add_routes([
             web.get("/", self._root_handler),
@@ -99,6 +156,7 @@ class SubstitutionPlan:
             web.post("/login", self._login_handler),
             web.get("/app.webmanifest", self._webmanifest),
             web.get("/api/wait-for-updates", self._wait_for_updates_handler),
+            web.get("/api/changes", self._changes_handler),
             web.post("/api/subscribe-push", self._subscribe_push_handler)
         ])
 
@@ -106,13 +164,16 @@ class SubstitutionPlan:
             log_helper.REQUEST_ID_CONTEXTVAR.set("bg-tasks")
             await self.update_substitutions(app)
 
-        for cron_time in background_updates:
-            aiocron.crontab(cron_time, func=update)
+        async def start_background_updates(app: web.Application):
+            self._scheduler.start(update)
+
+        app.on_startup.append(start_background_updates)
 
         return app
 
     async def cleanup(self):
-        for ws in self._websockets:
+        await self._scheduler.stop()
+        for ws in list(self._websockets.keys()):
             await ws.close()
         self._websockets.clear()
 
@@ -129,6 +190,10 @@ class SubstitutionPlan:
                 selection = [s.upper() for s in selection]
         return selection, selection_str, selection_qs
 
+    async def _render(self, **kwargs) -> str:
+        with metrics.RENDER_DURATION.time(plan=self._plan_id):
+            return await self._render_func(storage=self._crawler.storage, version=self._history.version, **kwargs)
+
     @log_helper.plan_name_wrapper
     async def update_substitutions(self, app: web.Application, fake_affected_groups=None):
         app["logger"].info("Updating substitutions...")
@@ -136,13 +201,46 @@ class SubstitutionPlan:
             changed = True
             affected_groups = fake_affected_groups
         else:
-            changed, affected_groups = await self._crawler.update(app["client_session"])
+            old_version_id = self._crawler.last_version_id
+            try:
+                with metrics.CRAWL_DURATION.time(plan=self._plan_id):
+                    changed, affected_groups = await self._crawler.update(app["crawler_session"])
+            except Exception:
+                metrics.UPDATES.inc(plan=self._plan_id, result="error")
+                raise
+            status_changed = self._crawler.last_version_id != old_version_id
+            self._scheduler.on_update(status_changed)
+            if status_changed:
+                await app["db"].add_status_change(self._plan_id, datetime.datetime.now(),
+                                            AdaptivePollingScheduler.HISTORY_DAYS)
+        metrics.UPDATES.inc(plan=self._plan_id, result="changed" if changed else "unchanged")
         if changed:
             app["logger"].info("Substitutions have changed")
-            self._index_site = await self._render_func(storage=self._crawler.storage)
+            if not fake_affected_groups:
+                self._add_version()
+            self._index_site = await self._render()
+            if self._snapshot_path and not fake_affected_groups:
+                # serialize now, the storage must not change while it's being written
+                snapshot = self._crawler.get_snapshot()
+                if snapshot is not None:
+                    await get_scheduler_from_app(app).spawn(self._save_snapshot(app, snapshot))
             await get_scheduler_from_app(app).spawn(self._on_new_substitutions(app, affected_groups))
         elif app["settings"].debug or self._index_site is None:
-            self._index_site = await self._render_func(storage=self._crawler.storage)
+            self._index_site = await self._render()
+
+    def _add_version(self):
+        storage = self._crawler.storage
+        if self._pending_changes is not None:
+            self._history.add(self._pending_changes)
+        elif storage is self._history_storage:
+            # the storage was modified in place, i.e. old days were removed. Clients remove days not listed anymore
+            # themselves
+            self._history.add(StorageChanges({}))
+        else:
+            # the storage was loaded without comparing it to a previous one
+            self._history.add(None)
+        self._pending_changes = None
+        self._history_storage = storage
 
     async def _check_auth(self, request, check_form=True):
         if not self.use_auth:
@@ -242,8 +340,7 @@ class SubstitutionPlan:
                     headers = headers.copy()
                     headers["X-Robots-Tag"] = "noindex"
             else:
-                text = await self._render_func(storage=self._crawler.storage,
-                                               selection=selection, selection_str=selection_str)
+                text = await self._render(selection=selection, selection_str=selection_str)
                 headers = headers.copy()
                 headers["X-Robots-Tag"] = "noindex"
 
@@ -298,11 +395,17 @@ class SubstitutionPlan:
             raise web.HTTPNotFound()
         await ws.prepare(request)
 
-        self._websockets.add(ws)
+        # clients register their selection and the version they show, so that only the changes relevant to them are
+        # sent instead of making them reload the page
+        try:
+            selection = self.parse_selection(request.url)[0]
+            self._websockets[ws] = (tuple(selection) if selection else None, int(request.query["version"]))
+        except (KeyError, ValueError):
+            self._websockets[ws] = None
         try:
             if not self._crawler.storage:
                 await self.update_substitutions(request.app)
-            await ws.send_json({"type": "status", "status": self._crawler.storage.status})
+            await self._send_update(ws)
             msg: WSMessage
             async for msg in ws:
                 request.app["logger"].debug("WebSocket: Got message " + str(msg))
@@ -317,14 +420,69 @@ class SubstitutionPlan:
                         if "type" in data:
                             if data["type"] == "get_status":
                                 await self.update_substitutions(request.app)
-                                await ws.send_json({"type": "status", "status": self._crawler.storage.status})
-            # no need to remove ws from self._websockets as self._websockets is a WeakSet
+                                await self._send_update(ws)
+            # no need to remove ws from self._websockets as self._websockets is a WeakKeyDictionary
         except (asyncio.CancelledError, asyncio.TimeoutError):
             pass
         finally:
             request.app["logger"].info(f"WebSocket connection closed: {ws.close_code}")
         return ws
 
+    def _get_update_message(self, selection: Optional[Tuple[str, ...]], version: int) -> str:
+        storage = self._crawler.storage
+        changes = self._history.get_changes(version, selection)
+        if changes is None:
+            # the client's version is unknown, it has to reload the page
+            return json.dumps({"type": "status", "status": storage.status, "reload": True})
+        return json.dumps({"type": "patch", "status": storage.status, "version": self._history.version,
+                           "dates": [day.date.isoformat() for day in storage.iter_days()], "changes": changes},
+                          separators=(",", ":"))
+
+    async def _send_update(self, ws: web.WebSocketResponse, messages: Dict[Tuple, str] = None):
+        """
+        Send the changes since the version the client knows, or only the status if the client did not register.
+        messages caches the messages for each distinct selection and version.
+        """
+        client = self._websockets.get(ws)
+        if client is None:
+            message = json.dumps({"type": "status", "status": self._crawler.storage.status})
+        else:
+            if messages is None:
+                message = self._get_update_message(*client)
+            elif (message := messages.get(client)) is None:
+                message = messages[client] = self._get_update_message(*client)
+            self._websockets[ws] = (client[0], self._history.version)
+        await ws.send_str(message)
+
+    # /api/changes
+    @log_helper.plan_name_wrapper
+    async def _changes_handler(self, request: web.Request):
+        if not (await self._check_auth(request, False))[0]:
+            raise web.HTTPForbidden()
+
+        await self.update_substitutions(request.app)
+        storage = self._crawler.storage
+        selection = self.parse_selection(request.url)[0]
+        try:
+            since = int(request.query["since"])
+        except (KeyError, ValueError):
+            changes = None
+        else:
+            changes = self._history.get_changes(since, selection)
+
+        data = {"version": self._history.version, "status": storage.status}
+        if changes is None:
+            # the client's version is unknown or too old
+            data["full"] = True
+            data["days"] = [day.to_data(selection) for day in storage.iter_days()]
+        else:
+            data["full"] = False
+            data["days"] = [{"date": day.date, "name": day.name, "datestr": day.datestr, "week": day.week,
+                             "news": day.news, "info": day.info} for day in storage.iter_days()]
+            data["changes"] = changes
+        return web.json_response(data, headers={hdrs.CACHE_CONTROL: "no-store"},
+                                 dumps=partial(json.dumps, default=datetime.date.isoformat, separators=(",", ":")))
+
     # /api/subscribe-push
     @log_helper.plan_name_wrapper
     async def _subscribe_push_handler(self, request: web.Request):
@@ -336,7 +494,7 @@ class SubstitutionPlan:
         try:
             data = await request.json()
             if data["is_active"]:
-                db.add_push_subscription(request.app, self._plan_id, data["subscription"], data["selection"])
+                await db.add_push_subscription(request.app, self._plan_id, data["subscription"], data["selection"])
                 if request.app["settings"].send_welcome_push_message:
                     if not await self.send_push_notification(
                             request.app,
@@ -348,120 +506,198 @@ class SubstitutionPlan:
                             }):
                         raise ValueError("Could not send push notification to newly subscribed endpoint")
             else:
-                db.delete_push_subscription(request.app, self._plan_id, data["subscription"]["endpoint"])
-            db.commit()
+                await db.delete_push_subscription(request.app, self._plan_id, data["subscription"]["endpoint"])
             response = web.json_response({"ok": True})
         except Exception:
             request.app["logger"].exception("Modifying push subscription failed")
             response = web.json_response({"ok": False}, status=400)
         return response
 
-    async def send_push_notification(self, app: web.Application, subscription: dict, data) -> bool:
+    async def send_push_notification(self, app: web.Application, subscription: dict, data: Union[dict, str]) -> bool:
+        """ data is the payload, either as dict or already serialized. Return False if the subscription expired. """
+        # noinspection PyBroadException
+        try:
+            r = await self.deliver_push_notification(app, subscription, data)
+        except Exception:
+            return True
+        return r.status not in (404, 410)
+
+    async def deliver_push_notification(self, app: web.Application, subscription: dict, data: Union[dict, str],
+                                        headers: Optional[Dict[str, str]] = None, ttl: int = DEFAULT_TTL,
+                                        max_retries: Optional[int] = None) -> PushResult:
+        """
+        Send a push notification and return the push service's answer. Raises if it could not be sent.
+
+        :param headers: additional headers like Topic and Urgency
+        :param ttl: seconds the push service keeps the message if the device is offline
+        :param max_retries: see PushSender.send()
+        """
         logger = app["logger"]
         settings: Settings = app["settings"]
 
         endpoint_hash = hash_endpoint(subscription["endpoint"])
-        # noinspection PyBroadException
         try:
             url = urlparse(subscription.get("endpoint"))  # copied from pywebpush.webpush
             aud = "{}://{}".format(url.scheme, url.netloc)
 
             logger.debug(f"Sending push notification to {self._plan_id}-{endpoint_hash[:6]} ({aud})")
 
-            endpoint, data, headers = pywebpush.webpush(
-                subscription, json.dumps(data),
-                vapid_private_key=settings.private_vapid_key,
-                vapid_claims={
-                    "sub": settings.vapid_sub,
-                    # "aud": endpoint_origin,  # aud is automatically set in webpush()
-                    # 86400s=24h, but 5s less because otherwise, requests sometimes fail (exp must not
-                    # be longer than 24 hours from the time the request is made)
-                    "exp": int(time.time()) + 86395,
-                    "aud": aud
-                },
-                content_encoding=settings.webpush_content_encoding,
-                ttl=86400,
-                curl=True)  # modifications to make this work: see beginning of this file
-            async with app["client_session"].post(endpoint, data=data, headers=headers) as r:
-                if r.status >= 400:
-                    # If status code is 404 or 410, the endpoints are unavailable, so delete the
-                    # subscription. See https://autopush.readthedocs.io/en/latest/http.html#error-codes.
-                    if r.status in (404, 410):
-                        logger.debug(f"No longer valid subscription {self._plan_id}-{endpoint_hash[:6]} ({aud}): "
-                                     f"{r.status} {r.reason} {repr(await r.text())}")
-                        return False
-                    else:
-                        logger.error(
-                            f"Could not send push notification to {self._plan_id}-{endpoint_hash[:6]} ({aud}): "
-                            f"{r.status} {r.reason} {repr(await r.text())}")
-                else:
-                    logger.debug(f"Successfully sent push notification to {self._plan_id}-{endpoint_hash[:6]}: "
-                                 f"{r.status} {r.reason} {repr(await r.text())}")
+            endpoint, data, headers = await app["push_encryptor"].encrypt(
+                subscription, data if isinstance(data, str) else json.dumps(data),
+                {**app["vapid_headers"].get(aud), **(headers or {})}, settings.webpush_content_encoding, ttl)
+            r = await app["push_sender"].send(endpoint, data, headers, max_retries)
         except Exception:
+            metrics.PUSH_SENT.inc(plan=self._plan_id, status="error")
             logger.exception(f"Could not send push notification to {self._plan_id}-{endpoint_hash[:6]}")
-        return True
+            raise
+        metrics.PUSH_SENT.inc(plan=self._plan_id, status=r.status)
+        if r.status in (404, 410):
+            logger.debug(f"No longer valid subscription {self._plan_id}-{endpoint_hash[:6]} ({aud}): "
+                         f"{r.status} {r.reason} {r.text!r}")
+        elif r.status >= 400:
+            logger.error(f"Could not send push notification to {self._plan_id}-{endpoint_hash[:6]} ({aud}): "
+                         f"{r.status} {r.reason} {r.text!r}")
+        else:
+            logger.debug(f"Successfully sent push notification to {self._plan_id}-{endpoint_hash[:6]}: "
+                         f"{r.status} {r.reason} {r.text!r}")
+        return r
+
+    def _get_push_messages(self, db: SubstitutionPlanDB, affected_groups) -> List[PushMessage]:
+        """ Return the push messages for all subscriptions affected by new substitutions. """
+        affected_days = [(date, int(time.mktime(date.timetuple())), day) for date, day in affected_groups.items()]
+        timestamp = self._crawler.storage.status_datetime.timestamp()
+        today = datetime.date.today()
+
+        index = db.get_push_subscriptions(self._plan_id)
+        # selection tokens which are contained in one of the day's affected groups
+        matched_tokens = [index.match_tokens(day["groups"]) for _, _, day in affected_days]
+
+        def get_message(selection: Optional[Tuple[str, ...]]) -> Optional[PushMessage]:
+            if selection is None:
+                # selection is None when all groups are selected
+                dates = [date for date, _, _ in affected_days]
+                intersection = {t: day for _, t, day in affected_days}
+            else:
+                dates = []
+                intersection = {}
+                for (date, t, day), tokens in zip(affected_days, matched_tokens):
+                    common_groups = [s for s in selection if s in tokens]
+                    if common_groups:
+                        dates.append(date)
+                        intersection[t] = {"name": day["name"], "groups": common_groups}
+                if not intersection:
+                    return None
+            payload = json.dumps({
+                "type": "subs_update",
+                "affected_groups_by_day": intersection,
+                "plan_id": self._plan_id,
+                # status_datetime.timestamp() correctly assumes that datetime is local
+                # time (status_datetime has no tzinfo) and returns the correct UTC
+                # timestamp
+                "timestamp": timestamp
+            })
+            # changes for today are delivered immediately, changes for later days may wait until the device is
+            # awake anyway
+            first_date = min(dates)
+            urgency = "high" if first_date <= today else "normal" if first_date == today + datetime.timedelta(1) \
+                else "low"
+            # after the last affected day, the message is useless
+            expires = datetime.datetime.combine(max(dates) + datetime.timedelta(1), datetime.time())
+            # a newer message for this plan replaces one which has not been delivered yet
+            return PushMessage(payload, [], self._push_topic, urgency, expires)
+
+        # Most subscribers of a class get exactly the same payload, so it is only built once per selection
+        # and subscriptions are grouped by it. Only encryption and sending is done per subscription.
+        messages_by_selection: Dict[Optional[Tuple[str, ...]], Optional[PushMessage]] = {}
+        messages: Dict[str, PushMessage] = {}
+        for endpoint, _, selection in index.iter_matching(set().union(*matched_tokens)):
+            if selection not in messages_by_selection:
+                messages_by_selection[selection] = get_message(selection)
+            if (message := messages_by_selection[selection]) is not None:
+                messages.setdefault(message.payload, message).endpoints.append(endpoint)
+        metrics.PUSH_FANOUT_PAYLOADS.set(len(messages), plan=self._plan_id)
+        return list(messages.values())
 
     # background task on new substitutions
-    async def _on_new_substitutions(self, app: web.Application, affected_groups):
+    async def _send_push_messages(self, app: web.Application, affected_groups):
         logger = app["logger"]
         db: SubstitutionPlanDB = app["db"]
+        push_messages = []
+        if affected_groups:
+            with metrics.PUSH_FANOUT_DURATION.time(plan=self._plan_id):
+                push_messages = self._get_push_messages(db, affected_groups)
+                # the push messages are committed together with the version id, so that they are sent even if the
+                # process stops before the outbox is drained. They wait for updates of other plans, so that devices
+                # subscribed to several plans get one message
+                await db.set_substitutions_version_id(self._plan_id, self._crawler.last_version_id, push_messages,
+                                                      app["settings"].push_dedup_window)
+            logger.debug(f"Added push messages for {sum(len(m.endpoints) for m in push_messages)} subscriptions "
+                         f"with {len(push_messages)} distinct payloads to the outbox")
+        else:
+            await db.set_substitutions_version_id(self._plan_id, self._crawler.last_version_id)
+        logger.debug(f"Changed last substitution version id to: {self._crawler.last_version_id!r}")
+        if push_messages:
+            app["push_outbox"].wake()
+
+    async def _debounce_push_messages(self, app: web.Application, affected_groups):
+        """
+        Collect the affected groups of all updates within push_debounce seconds after the first one and send one
+        push message for all of them, as plans are often uploaded in several passes.
+        """
+        if self._debounced_affected_groups is None:
+            self._debounced_affected_groups = {}
+            await get_scheduler_from_app(app).spawn(self._send_debounced_push_messages(app))
+        elif affected_groups:
+            metrics.PUSH_DEBOUNCED_UPDATES.inc(plan=self._plan_id)
+        for date, day in affected_groups.items():
+            if (debounced_day := self._debounced_affected_groups.get(date)) is None:
+                self._debounced_affected_groups[date] = {"name": day["name"], "groups": list(day["groups"])}
+            else:
+                debounced_day["name"] = day["name"]
+                debounced_day["groups"].extend(g for g in day["groups"] if g not in debounced_day["groups"])
 
+    async def _send_debounced_push_messages(self, app: web.Application):
         log_helper.REQUEST_ID_CONTEXTVAR.set(None)
+        await asyncio.sleep(self._push_debounce)
+        affected_groups = self._debounced_affected_groups
+        self._debounced_affected_groups = None
         # noinspection PyBroadException
         try:
-            db.set_substitutions_version_id(self._plan_id, self._crawler.last_version_id)
-            logger.debug(f"Changed last substitution version id to: {self._crawler.last_version_id!r}")
+            await self._send_push_messages(app, affected_groups)
+        except Exception:
+            app["logger"].exception("Exception while sending debounced push messages")
 
-            # WEBSOCKETS
+    # background task on new substitutions
+    async def _on_new_substitutions(self, app: web.Application, affected_groups):
+        logger = app["logger"]
+
+        log_helper.REQUEST_ID_CONTEXTVAR.set(None)
+        # WEBSOCKETS
+        # clients are updated first, so that they don't depend on the database
+        # noinspection PyBroadException
+        try:
             logger.debug(f"Sending update event via WebSocket connection to {len(self._websockets)} clients")
-            for ws in self._websockets:
-                # noinspection PyBroadException
-                try:
-                    await ws.send_json({"type": "status", "status": self._crawler.storage.status})
-                except Exception:
-                    pass
-
-            # PUSH NOTIFICATIONS
-            if affected_groups:
-                logger.debug("Sending affected groups via push messages")
-
-                def iter_relevant_subscriptions():
-                    row: sqlite3.Row
-                    for row in db.iter_push_subscriptions(self._plan_id):
-                        selection = row["selection"]
-                        if selection is None:
-                            # selection is None when all groups are selected
-                            yield row["subscription"], {int(time.mktime(date.timetuple())): day for date, day in affected_groups.items()}
-                        else:
-                            intersection = {}
-                            for date, day in affected_groups.items():
-                                groups = day["groups"]
-                                common_groups = [s for s in selection if any(s in g for g in groups)]
-                                if common_groups:
-                                    intersection[int(time.mktime(date.timetuple()))] = {"name": day["name"], "groups": common_groups}
-                            if intersection:
-                                yield row["subscription"], intersection
-
-                timestamp = self._crawler.storage.status_datetime.timestamp()
-
-                async def send_notification(subscription, common_affected_groups):
-                    data = {
-                        "type": "subs_update",
-                        "affected_groups_by_day": common_affected_groups,
-                        "plan_id": self._plan_id,
-                        # status_datetime.timestamp() correctly assumes that datetime is local
-                        # time (status_datetime has no tzinfo) and returns the correct UTC
-                        # timestamp
-                        "timestamp": timestamp
-                    }
-                    if not await self.send_push_notification(app, subscription, data):
-                        return subscription["endpoint"]
-
-                endpoints_to_delete: Iterable[Optional[str]] = await asyncio.gather(
-                    *(send_notification(s, c) for s, c in iter_relevant_subscriptions()))
-                for endpoint in endpoints_to_delete:
-                    if endpoint is not None:
-                        db.delete_push_subscription(app, self._plan_id, endpoint)
-                db.commit()
+            with metrics.BROADCAST_DURATION.time(plan=self._plan_id):
+                # clients with the same selection and version get the same message, which is only created once
+                messages = {}
+                for ws in list(self._websockets.keys()):
+                    # noinspection PyBroadException
+                    try:
+                        await self._send_update(ws, messages)
+                    except Exception:
+                        pass
+                logger.debug(f"Sent {len(messages)} distinct update messages")
+        except Exception:
+            logger.exception("Exception while sending updates via WebSocket")
+
+        # PUSH NOTIFICATIONS
+        # noinspection PyBroadException
+        try:
+            if self._push_debounce and (affected_groups or self._debounced_affected_groups is not None):
+                # The version id is only stored together with the push messages when the window closes. If the
+                # process stops before, the changes are detected again after the restart.
+                await self._debounce_push_messages(app, affected_groups or {})
+            else:
+                await self._send_push_messages(app, affected_groups)
         except Exception:
-            logger.exception("Exception in on_new_substitutions background task")
+            logger.exception("Exception while adding push messages")
@@ -0,0 +1,75 @@
+"""
+Micro-benchmarks for the class name utilities in app/subs_crawler/utils.py, with and without CLASS_NAME_CACHE.
+
+The corpus resembles a week of a plan: every row's class and lesson strings are parsed, but there are only a few
+hundred distinct ones.
+
+Run from the repository's root directory: python3 dev/bench_class_names.py
+"""
+
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+
+from subs_crawler import utils  # noqa: E402
+
+ROWS = 5 * 500
+GRADES = range(5, 11)
+LETTERS = "ABCDEF"
+COURSE_CLASSES = ["11", "12", "13", "E", "Q1", "Q2", "Sek II", "DaZ", "AG Chor", "Förderkurs"]
+LESSONS = [str(i) for i in range(1, 11)] + [f"{i} - {i + 1}" for i in range(1, 10, 2)] + ["5/6", "7.", "8. Std."]
+
+
+def class_names(rnd: random.Random):
+    """ Class names like Untis and WebUntis output them, before and after simplify_class_name(). """
+    for _ in range(ROWS):
+        grade = rnd.choice(GRADES)
+        kind = rnd.random()
+        if kind < .6:
+            name = f"{grade}{rnd.choice(LETTERS)}"
+        elif kind < .75:
+            name = ", ".join(f"{grade}{letter}" for letter in sorted(rnd.sample(LETTERS, rnd.randint(2, 4))))
+        elif kind < .85:
+            name = rnd.choice(COURSE_CLASSES)
+        elif kind < .95:
+            name = f"({grade}{rnd.choice(LETTERS)})"
+        else:
+            name = f"{grade}{rnd.choice(LETTERS)}{rnd.choice(LETTERS)}, {rnd.choice(COURSE_CLASSES)}"
+        yield name
+
+
+def build_corpus(seed: int = 0):
+    rnd = random.Random(seed)
+    names = list(class_names(rnd))
+    simplified = [utils.simplify_class_name.__wrapped__(name) for name in names]
+    lessons = [rnd.choice(LESSONS) for _ in range(ROWS)]
+    return names, simplified, lessons
+
+
+def bench(name: str, func, corpus, number: int = 20):
+    uncached = func.__wrapped__
+    t_uncached = min(timeit.repeat(lambda: [uncached(s) for s in corpus], number=number, repeat=3)) / number
+    utils.CLASS_NAME_CACHE.cache_clear()
+    # first run fills the cache, like the first crawl after start
+    t_cold = timeit.timeit(lambda: [func(s) for s in corpus], number=1)
+    t_warm = min(timeit.repeat(lambda: [func(s) for s in corpus], number=number, repeat=3)) / number
+    print(f"{name:<22} {len(set(corpus)):>9} {t_uncached * 1e3:>10.2f} {t_cold * 1e3:>10.2f} {t_warm * 1e3:>10.2f}")
+
+
+if __name__ == "__main__":
+    names, simplified, lessons = build_corpus()
+    print(f"{ROWS} rows per run, times in ms per run")
+    print(f"{'function':<22} {'distinct':>9} {'uncached':>10} {'cold':>10} {'warm':>10}")
+    bench("simplify_class_name", utils.simplify_class_name, names)
+    bench("split_class_name", utils.split_class_name, simplified)
+    bench("parse_affected_groups", utils.parse_affected_groups, simplified)
+    bench("get_lesson_num", utils.get_lesson_num, lessons)
+    utils.CLASS_NAME_CACHE.cache_clear()
+    for func, corpus in ((utils.simplify_class_name, names), (utils.split_class_name, simplified),
+                         (utils.parse_affected_groups, simplified), (utils.get_lesson_num, lessons)):
+        for s in corpus:
+            func(s)
+    print(f"shared cache after parsing all columns: {utils.CLASS_NAME_CACHE.cache_info()}")
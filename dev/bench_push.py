@@ -0,0 +1,290 @@
+"""
+Load test for push notifications: measure how fast a fan-out reaches thousands of subscribers.
+
+For every subscriber count, a fresh database is seeded with synthetic subscriptions (with real P-256 keys) and
+SubstitutionPlan._on_new_substitutions() is run for an update affecting all classes. The push messages are sent
+through the outbox, PushSender and PushEncryptor like in production, to a local stand-in for a push service running
+in a separate process. The stand-in checks the VAPID JWT and decrypts the aes128gcm payloads, and can answer with
+404, 410 or 429 or add latency.
+
+Reported are notifications per second (until the outbox is drained), CPU time per notification of the app's process
+(including the encryption threads) and the event loop lag during the fan-out.
+
+Run from the repository's root directory: python3 dev/bench_push.py [--subscribers 1000 10000 100000]
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import aiohttp
+import http_ece
+from aiohttp import web
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils as ec_utils
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.db import SubstitutionPlanDB  # noqa: E402
+from app.push import PushEncryptor, PushOutbox, PushSender, VapidHeaders  # noqa: E402
+from app.settings import Settings  # noqa: E402
+from app.substitution_plan import SubstitutionPlan  # noqa: E402
+
+PLAN_ID = "bench"
+CLASSES = [f"{grade}{letter}" for grade in range(5, 11) for letter in "ABCD"] + ["11", "12", "13"]
+CURVE_ORDER = 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551
+
+
+def b64decode(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+
+def b64encode(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).decode("ascii").rstrip("=")
+
+
+def subscriber_keys(i: int) -> Tuple[ec.EllipticCurvePrivateKey, bytes]:
+    """ Keys of subscriber i, derived from i so that the receiver doesn't need to get them from the app. """
+    secret = int.from_bytes(hashlib.sha256(f"key-{i}".encode()).digest(), "big") % (CURVE_ORDER - 1) + 1
+    return ec.derive_private_key(secret, ec.SECP256R1()), hashlib.sha256(f"auth-{i}".encode()).digest()[:16]
+
+
+def generate_vapid_key() -> str:
+    return b64encode(ec.generate_private_key(ec.SECP256R1()).private_numbers().private_value.to_bytes(32, "big"))
+
+
+# RECEIVER
+
+class Receiver:
+    """ Stand-in for a push service, see the module's docstring. """
+
+    def __init__(self, origin: str, latency: float, rate_404: float, rate_410: float, rate_429: float):
+        self._origin = origin
+        self._latency = latency
+        self._rate_404 = rate_404
+        self._rate_410 = rate_410
+        self._rate_429 = rate_429
+        self._keys: Dict[int, Tuple[ec.EllipticCurvePrivateKey, bytes]] = {}
+        # JWTs are reused by VapidHeaders, so each one only needs to be verified once
+        self._verified_tokens = set()
+        self.stats = {}
+        self.reset()
+
+    def reset(self):
+        self.stats = {"requests": 0, "decrypted": 0, "invalid": 0, "404": 0, "410": 0, "429": 0}
+
+    def _check_vapid(self, authorization: str):
+        if not authorization.startswith("vapid "):
+            raise ValueError(f"Wrong authorization scheme: {authorization!r}")
+        params = dict(p.strip().split("=", 1) for p in authorization[len("vapid "):].split(","))
+        token = params["t"]
+        if token in self._verified_tokens:
+            return
+        header, claims, signature = token.split(".")
+        claims_data = json.loads(b64decode(claims))
+        if claims_data["aud"] != self._origin:
+            raise ValueError(f"Wrong aud {claims_data['aud']!r}")
+        if not time.time() < claims_data["exp"] <= time.time() + 24*60*60:
+            raise ValueError(f"Wrong exp {claims_data['exp']!r}")
+        if not claims_data.get("sub"):
+            raise ValueError("No sub")
+        public_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), b64decode(params["k"]))
+        raw_signature = b64decode(signature)
+        public_key.verify(ec_utils.encode_dss_signature(int.from_bytes(raw_signature[:32], "big"),
+                                                        int.from_bytes(raw_signature[32:], "big")),
+                          f"{header}.{claims}".encode("ascii"), ec.ECDSA(hashes.SHA256()))
+        self._verified_tokens.add(token)
+
+    async def push_handler(self, request: web.Request):
+        self.stats["requests"] += 1
+        i = int(request.match_info["i"])
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        r = random.random()
+        if r < self._rate_404:
+            self.stats["404"] += 1
+            return web.Response(status=404)
+        if r < self._rate_404 + self._rate_410:
+            self.stats["410"] += 1
+            return web.Response(status=410)
+        if random.random() < self._rate_429:
+            self.stats["429"] += 1
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        try:
+            self._check_vapid(request.headers["Authorization"])
+            if (request.headers["Content-Encoding"] != "aes128gcm" or int(request.headers["TTL"]) <= 0
+                    or request.headers["Urgency"] not in ("very-low", "low", "normal", "high")
+                    or not request.headers["Topic"]):
+                raise ValueError("Wrong headers")
+            if i not in self._keys:
+                self._keys[i] = subscriber_keys(i)
+            private_key, auth_secret = self._keys[i]
+            payload = json.loads(http_ece.decrypt(await request.read(), private_key=private_key,
+                                                  auth_secret=auth_secret, version="aes128gcm"))
+            if payload["type"] != "subs_update" or payload["plan_id"] != PLAN_ID:
+                raise ValueError(f"Wrong payload {payload!r}")
+        except (KeyError, ValueError, InvalidSignature) as e:
+            self.stats["invalid"] += 1
+            return web.Response(status=400, text=repr(e))
+        self.stats["decrypted"] += 1
+        return web.Response(status=201)
+
+    async def stats_handler(self, request: web.Request):
+        stats = dict(self.stats)
+        if request.method == "POST":
+            self.reset()
+        return web.json_response(stats)
+
+
+def run_receiver(port: int, latency: float, rate_404: float, rate_410: float, rate_429: float):
+    receiver = Receiver(f"http://127.0.0.1:{port}", latency, rate_404, rate_410, rate_429)
+    app = web.Application()
+    app.add_routes([
+        web.post("/push/{i}", receiver.push_handler),
+        web.get("/stats", receiver.stats_handler),
+        web.post("/stats", receiver.stats_handler),
+    ])
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+# APP
+
+async def seed(db: SubstitutionPlanDB, app, subscribers: int, port: int):
+    rnd = random.Random(subscribers)
+    adds = []
+    for i in range(subscribers):
+        private_key, auth_secret = subscriber_keys(i)
+        p256dh = private_key.public_key().public_bytes(serialization.Encoding.X962,
+                                                       serialization.PublicFormat.UncompressedPoint)
+        subscription = {"endpoint": f"http://127.0.0.1:{port}/push/{i}",
+                        "keys": {"p256dh": b64encode(p256dh), "auth": b64encode(auth_secret)}}
+        # some subscribers select all classes
+        selection = "" if rnd.random() < .1 else ",".join(rnd.sample(CLASSES, rnd.choice((1, 1, 1, 2, 3))))
+        adds.append(db.add_push_subscription(app, PLAN_ID, subscription, selection))
+        if len(adds) == 1000:
+            # committed in one transaction
+            await asyncio.gather(*adds)
+            adds = []
+    await asyncio.gather(*adds)
+
+
+async def measure_lag(lags: List[float], interval: float = .01):
+    loop = asyncio.get_running_loop()
+    while True:
+        t1 = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(loop.time() - t1 - interval, 0))
+
+
+async def run(subscribers: int, port: int, settings: Settings) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        app = {"settings": settings, "logger": logging.getLogger("openvplan"),
+               "db": SubstitutionPlanDB(os.path.join(directory, "db.sqlite3"))}
+        db: SubstitutionPlanDB = app["db"]
+        await db.open()
+        await seed(db, app, subscribers, port)
+
+        crawler = types.SimpleNamespace(last_version_id="bench",
+                                        storage=types.SimpleNamespace(status_datetime=datetime.datetime.now()))
+
+        async def render(*args, **kwargs):
+            return ""
+
+        plan = SubstitutionPlan(app, PLAN_ID, crawler, render, {"title": "Bench", "description": ""})
+        app["substitution_plans"] = {PLAN_ID: plan}
+        app["push_sender"] = PushSender(settings.push_workers, settings.push_origin_concurrency,
+                                        settings.push_origin_rate, settings.push_max_retries,
+                                        settings.request_timeout)
+        app["vapid_headers"] = VapidHeaders(settings.private_vapid_key, settings.vapid_sub)
+        app["push_encryptor"] = PushEncryptor(settings.push_encryption_workers)
+        app["push_outbox"] = PushOutbox(app, settings.push_outbox_batch_size, settings.push_outbox_max_attempts)
+        # retry messages answered with 429 soon, so that the outbox is drained within the benchmark
+        app["push_outbox"].RETRY_BASE_DELAY = 1
+        await app["push_sender"].start()
+        await app["push_outbox"].start()
+
+        affected_groups = {datetime.date.today(): {"name": "Montag", "groups": CLASSES}}
+        lags = []
+        lag_task = asyncio.create_task(measure_lag(lags))
+        cpu1 = time.process_time()
+        t1 = time.perf_counter()
+        await plan._on_new_substitutions(app, affected_groups)
+        queued = await db.get_push_outbox_size()
+        while await db.get_push_outbox_size():
+            await asyncio.sleep(.05)
+        duration = time.perf_counter() - t1
+        cpu = time.process_time() - cpu1
+        lag_task.cancel()
+
+        await app["push_outbox"].close()
+        await app["push_sender"].close()
+        app["push_encryptor"].close()
+        dead_letters = await db.get_push_dead_letter_count()
+        await db.close()
+    return {"queued": queued, "duration": duration, "cpu": cpu, "lags": lags, "dead_letters": dead_letters}
+
+
+async def main(args):
+    settings = Settings(default_plan_id=PLAN_ID, substitution_plans={},
+                        private_vapid_key=generate_vapid_key(), vapid_sub="mailto:bench@example.org",
+                        push_origin_rate=args.origin_rate, push_origin_concurrency=args.origin_concurrency,
+                        push_dedup_window=0)
+    receiver = multiprocessing.Process(target=run_receiver, args=(args.port, args.latency / 1000, args.rate_404,
+                                                                  args.rate_410, args.rate_429), daemon=True)
+    receiver.start()
+    stats_url = f"http://127.0.0.1:{args.port}/stats"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(stats_url):
+                    break
+            except aiohttp.ClientError:
+                await asyncio.sleep(.1)
+
+        print(f"workers: {settings.push_workers}, encryption workers: {settings.push_encryption_workers}, "
+              f"latency: {args.latency}ms, 404: {args.rate_404:.0%}, 410: {args.rate_410:.0%}, "
+              f"429: {args.rate_429:.0%}")
+        print(f"{'subscribers':>11} {'messages':>8} {'msg/s':>8} {'CPU ms/msg':>10} {'lag p50':>8} {'lag p99':>8} "
+              f"{'lag max':>8} {'decrypted':>9} {'invalid':>7} {'dead':>5}")
+        for subscribers in args.subscribers:
+            result = await run(subscribers, args.port, settings)
+            async with session.post(stats_url) as r:
+                stats = await r.json()
+            lags = sorted(result["lags"]) or [0]
+            print(f"{subscribers:>11} {result['queued']:>8} {result['queued'] / result['duration']:>8.0f} "
+                  f"{result['cpu'] / max(result['queued'], 1) * 1000:>10.3f} "
+                  f"{statistics.median(lags) * 1000:>6.1f}ms {lags[int(len(lags) * .99)] * 1000:>6.1f}ms "
+                  f"{lags[-1] * 1000:>6.1f}ms {stats['decrypted']:>9} {stats['invalid']:>7} "
+                  f"{result['dead_letters']:>5}")
+    receiver.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0, help="latency of the push service in ms")
+    parser.add_argument("--rate-404", type=float, default=0, help="share of requests answered with 404")
+    parser.add_argument("--rate-410", type=float, default=0, help="share of requests answered with 410")
+    parser.add_argument("--rate-429", type=float, default=0, help="share of requests answered with 429")
+    parser.add_argument("--origin-rate", type=float, default=0,
+                        help="PUSH_ORIGIN_RATE, by default there is no limit for the local push service")
+    parser.add_argument("--origin-concurrency", type=int, default=50, help="PUSH_ORIGIN_CONCURRENCY")
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("openvplan").setLevel(logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""
+Measure the memory needed per substitution row.
+
+"before" uses frozen dataclasses with a __dict__ and a set of affected groups per row, like
+SubstitutionGroup/Substitution did before, "after" uses the classes from app/subs_crawler/storage.py.
+
+Run from the repository's root directory: python3 dev/bench_storage_memory.py
+"""
+
+import dataclasses
+import gc
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+
+from subs_crawler.storage import Substitution, SubstitutionGroup  # noqa: E402
+from subs_crawler.utils import parse_affected_groups  # noqa: E402
+
+DAYS = 5
+CLASSES = [f"{grade}{letter}" for grade in range(5, 11) for letter in "ABCD"] + ["11", "12", "13"]
+ROWS_PER_CLASS = 12
+TEACHERS = ["".join(random.Random(i).choices("ABCDEFGHIJKLMNOPQRSTUVWXYZ", k=3)) for i in range(80)]
+SUBJECTS = ["De", "Ma", "En", "Fr", "La", "Bio", "Ch", "Ph", "Ek", "Ge", "Po", "Mu", "Ku", "Sp", "Re", "WN"]
+ROOMS = [f"{building}{num:03}" for building in "ABC" for num in range(1, 30)]
+NOTES = ["", "Aufgaben", "fällt aus", "Raumänderung", "Vertretung", "EVA"]
+
+
+@dataclasses.dataclass(frozen=True)
+class OldSubstitution:
+    data: Tuple[str, ...]
+    lesson_num: Optional[int] = None
+    affected_groups: Optional[Set[str]] = dataclasses.field(default=None, compare=False)
+
+
+@dataclasses.dataclass(frozen=True)
+class OldSubstitutionGroup:
+    name: str
+    striked: bool
+    substitutions: List[OldSubstitution]
+    id: Tuple[str, bool] = dataclasses.field(init=False, compare=False)
+    affected_groups: Optional[Set[str]] = dataclasses.field(init=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "id", (self.name, self.striked))
+        object.__setattr__(self, "affected_groups", set(parse_affected_groups(self.name)[0]))
+
+
+def generate_rows(seed: int):
+    rnd = random.Random(seed)
+    for _ in range(DAYS):
+        for class_name in CLASSES:
+            rows = []
+            for _ in range(ROWS_PER_CLASS):
+                lesson = rnd.randint(1, 10)
+                # build new str objects, as a parser would do
+                rows.append((lesson, tuple("".join(list(s)) for s in (
+                    class_name, rnd.choice(TEACHERS), rnd.choice(TEACHERS), str(lesson), rnd.choice(SUBJECTS),
+                    rnd.choice(ROOMS), rnd.choice(TEACHERS), rnd.choice(NOTES)))))
+            yield class_name, rows
+
+
+def build_old(rows):
+    return [OldSubstitutionGroup(class_name, False,
+                                 [OldSubstitution(data, lesson, set(parse_affected_groups(data[0])[0]))
+                                  for lesson, data in group_rows])
+            for class_name, group_rows in rows]
+
+
+def build_new(rows):
+    return [SubstitutionGroup(class_name, False,
+                              [Substitution(data, lesson, True, [1]) for lesson, data in group_rows])
+            for class_name, group_rows in rows]
+
+
+def measure(build, versions: int = 3) -> float:
+    row_count = versions * DAYS * len(CLASSES) * ROWS_PER_CLASS
+    gc.collect()
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    # rows are generated while measuring, so that duplicate strings are included. Several versions are kept alive
+    # like consecutive versions of a plan.
+    result = [build(generate_rows(seed)) for seed in range(versions)]
+    gc.collect()
+    size = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, "filename"))
+    tracemalloc.stop()
+    del result
+    return size / row_count
+
+
+if __name__ == "__main__":
+    before = measure(build_old)
+    after = measure(build_new)
+    print(f"rows per version: {DAYS * len(CLASSES) * ROWS_PER_CLASS}")
+    print(f"before: {before:.0f} bytes per substitution")
+    print(f"after:  {after:.0f} bytes per substitution ({(1 - after / before) * 100:.0f}% less)")
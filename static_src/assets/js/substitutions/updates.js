@@ -17,6 +17,7 @@
  */
 
 const onlineStatus = document.getElementById("online-status");
+const statusElement = document.getElementById("status");
 
 let webSocket = null;
 
@@ -35,10 +36,119 @@ function onUpdating() {
     onlineStatus.classList.add("updating");
     onlineStatus.classList.remove("online", "offline");
 }
+function getRowData(row) {
+    const data = [];
+    for (let td of row.children) {
+        if (!td.classList.contains("group-name"))
+            data.push(td.textContent.trim());
+    }
+    return data.join("\n");
+}
+
+function getGroupRows(tableBody, name, striked) {
+    let groupRows = null;
+    for (let row of tableBody.rows) {
+        const groupNameCell = row.querySelector(".group-name");
+        if (groupNameCell != null) {
+            if (groupRows != null)
+                break;
+            if (groupNameCell.textContent.trim() === name && (groupNameCell.querySelector("strike") != null) === striked)
+                groupRows = [];
+        }
+        if (groupRows != null)
+            groupRows.push(row);
+    }
+    return groupRows || [];
+}
+
+function removeRow(groupRows, index) {
+    const groupNameCell = groupRows[0].querySelector(".group-name");
+    const row = groupRows[index];
+    groupRows.splice(index, 1);
+    if (index === 0 && groupRows.length > 0) {
+        groupRows[0].prepend(groupNameCell);
+        groupRows[0].classList.add("first-of-group");
+    }
+    groupNameCell.rowSpan = groupRows.length;
+    row.remove();
+}
+
+function addRow(groupRows, data, lesson, isFirstDay) {
+    const row = document.createElement("tr");
+    // like the server-rendered rows
+    if (isFirstDay && lesson != null)
+        row.classList.add("lesson" + lesson);
+    row.classList.add("new-subs");
+    for (let d of data) {
+        const td = document.createElement("td");
+        td.textContent = d;
+        row.appendChild(td);
+    }
+    groupRows[groupRows.length - 1].after(row);
+    groupRows[0].querySelector(".group-name").rowSpan = groupRows.length + 1;
+    groupRows.push(row);
+}
+
+// Apply the rows added and removed since the shown version. Returns false if the page has to be reloaded instead.
+function applyPatch(msg) {
+    const boxes = {};
+    for (let box of document.getElementsByClassName("substitutions-box"))
+        boxes[box.dataset.date] = box;
+    // the server only marks the rows of the first day with their lessons
+    const firstDate = msg.dates[0];
+    const firstBox = document.querySelector(".substitutions-box");
+    if (firstBox && firstBox.dataset.date !== firstDate)
+        return false;
+    for (let date of msg.dates) {
+        if (!(date in boxes))
+            return false;
+    }
+    const tableBodies = {};
+    for (let change of msg.changes) {
+        if (!(change.date in tableBodies)) {
+            const table = boxes[change.date] && boxes[change.date].querySelector(".substitutions-table");
+            if (!table || !table.tBodies.length)
+                return false;
+            tableBodies[change.date] = table.tBodies[0];
+        }
+    }
+
+    for (let change of msg.changes) {
+        const tableBody = tableBodies[change.date];
+        const groupRows = getGroupRows(tableBody, change.name, !!change.striked);
+        for (let data of change.removed) {
+            const key = data.join("\n");
+            const index = groupRows.findIndex(row => getRowData(row) === key);
+            if (index === -1)
+                return false;
+            removeRow(groupRows, index);
+        }
+        // a new group is rendered by the server, it must be sorted into the table and may get a bookmark link
+        if (change.added.length && groupRows.length === 0)
+            return false;
+        change.added.forEach((data, i) =>
+            addRow(groupRows, data, change.added_lessons[i], change.date === firstDate));
+    }
+    for (let [date, box] of Object.entries(boxes)) {
+        if (!msg.dates.includes(date))
+            box.remove();
+    }
+    statusElement.textContent = msg.status;
+    statusElement.dataset.version = msg.version;
+    greySubstitutions();
+    return true;
+}
+
 function createWebSocket() {
+    // register selection and shown version, so that the server only sends the changes relevant for this page
+    const params = new URLSearchParams();
+    for (let s of new URLSearchParams(window.location.search).getAll("s"))
+        params.append("s", s);
+    if (statusElement.dataset.version)
+        params.set("version", statusElement.dataset.version);
     webSocket = new WebSocket(
         (window.location.protocol === "http:" ? "ws:" : "wss:") + "//" +
-        window.location.host + window.location.pathname + "api/wait-for-updates");
+        window.location.host + window.location.pathname + "api/wait-for-updates?" + params.toString());
 
     webSocket.addEventListener("open", event => {
         onOnline();
@@ -55,12 +165,18 @@ function createWebSocket() {
             case "status":
                 let status = msg.status;
                 if (status) {
-                    if (status === document.getElementById("status").textContent)
+                    if (!msg.reload && status === statusElement.textContent)
                         onOnline();
                     else
                         window.location.reload();
                 }
                 break;
+            case "patch":
+                if (applyPatch(msg))
+                    onOnline();
+                else
+                    window.location.reload();
+                break;
             default:
                 console.warn("Unknown WebSocket message type", msg.type);
                 break;
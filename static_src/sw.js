@@ -204,6 +204,81 @@ self.addEventListener("fetch", event => {
     }
 });
 
+function showSubsUpdate(data) {
+    //let timestamp = data["timestamp"];
+    let plan_id = data["plan_id"];
+
+    // merge all affected groups of previous notifications with the same plan id that are still open
+    let affectedGroups = data["affected_groups_by_day"];
+    console.log("affectedGroups", affectedGroups);
+    for (let day of Object.values(affectedGroups)) {
+        day["groups"] = new Set(day["groups"]);
+    }
+    let currentTimestamp = Date.now()/1000;  // current UTC timestamp in seconds
+    return self.registration.getNotifications().then(notifications => {
+        let notificationCount = 1;
+        for (let n of notifications) {
+            if (n.data && n.data.plan_id === plan_id) {
+                for (let [expiryTime, day] of Object.entries(n.data.affected_groups_by_day)) {
+                    console.log("expiryTime, currentTimestamp:", expiryTime, currentTimestamp);
+                    if (expiryTime > currentTimestamp) {
+                        console.log("add", day["groups"]);
+                        if (expiryTime in affectedGroups) {
+                            day["groups"].forEach(g => affectedGroups[expiryTime]["groups"].add(g));
+                        } else {
+                            day["groups"] = new Set(day["groups"]);
+                            affectedGroups[expiryTime] = day;
+                        }
+                    }
+                }
+                n.close();
+                if (n.data.notification_count)
+                    notificationCount += n.data.notification_count;
+            }
+        }
+        for (let day of Object.values(affectedGroups)) {
+            day["groups"] = Array.from(day["groups"]);
+        }
+
+        let title;
+        let body;
+
+        if (Object.keys(affectedGroups).length === 1) {
+            // there is only one day with new substitutions
+            let day = Object.values(affectedGroups)[0];
+            title = day["name"] + ": Neue Vertretungen";
+            body = day["groups"].join(", ");
+        } else {
+            title = "Neue Vertretungen";
+            body = "";
+            for (let day of Object.values(affectedGroups)) {
+                body += day["name"] + ": " + day["groups"].join(", ") + "\n";
+            }
+        }
+
+        const options = {
+            body: body,
+            icon: "android-chrome-512x512.png",
+            badge: "monochrome-96x96.png",
+            lang: "de",
+            //timestamp: timestamp,
+            vibrate: [300, 100, 400],
+            data: {
+                type: "subs_update",
+                plan_id: plan_id,
+                url: new URL("/" + plan_id + "/?source=Notification", self.location.origin).href,
+                affected_groups_by_day: affectedGroups,
+                notification_count: notificationCount,
+            }
+        };
+
+        return Promise.all([
+            self.registration.showNotification(title, options),
+            plausible("Notification", {props: {[plan_id]: "Received"}})
+        ]);
+    });
+}
+
 self.addEventListener("push", async (event) => {
     if (!event.data) {
         event.waitUntil(Promise.all([
@@ -231,80 +306,12 @@ self.addEventListener("push", async (event) => {
                 }
             })
         );
+    } else if (data.type === "subs_updates") {
+        // updates of several plans, combined into one push message
+        event.waitUntil(data.updates.reduce(
+            (promise, update) => promise.then(() => showSubsUpdate(update)), Promise.resolve()));
     } else {
-        //let timestamp = data["timestamp"];
-        let plan_id = data["plan_id"];
-
-        // merge all affected groups of previous notifications with the same plan id that are still open
-        let affectedGroups = data["affected_groups_by_day"];
-        console.log("affectedGroups", affectedGroups);
-        for (let day of Object.values(affectedGroups)) {
-            day["groups"] = new Set(day["groups"]);
-        }
-        let currentTimestamp = Date.now()/1000;  // current UTC timestamp in seconds
-        event.waitUntil(
-            self.registration.getNotifications().then(notifications => {
-                let notificationCount = 1;
-                for (let n of notifications) {
-                    if (n.data && n.data.plan_id === plan_id) {
-                        for (let [expiryTime, day] of Object.entries(n.data.affected_groups_by_day)) {
-                            console.log("expiryTime, currentTimestamp:", expiryTime, currentTimestamp);
-                            if (expiryTime > currentTimestamp) {
-                                console.log("add", day["groups"]);
-                                if (expiryTime in affectedGroups) {
-                                    day["groups"].forEach(g => affectedGroups[expiryTime]["groups"].add(g));
-                                } else {
-                                    day["groups"] = new Set(day["groups"]);
-                                    affectedGroups[expiryTime] = day;
-                                }
-                            }
-                        }
-                        n.close();
-                        if (n.data.notification_count)
-                            notificationCount += n.data.notification_count;
-                    }
-                }
-                for (let day of Object.values(affectedGroups)) {
-                    day["groups"] = Array.from(day["groups"]);
-                }
-
-                let title;
-                let body;
-
-                if (Object.keys(affectedGroups).length === 1) {
-                    // there is only one day with new substitutions
-                    let day = Object.values(affectedGroups)[0];
-                    title = day["name"] + ": Neue Vertretungen";
-                    body = day["groups"].join(", ");
-                } else {
-                    title = "Neue Vertretungen";
-                    body = "";
-                    for (let day of Object.values(affectedGroups)) {
-                        body += day["name"] + ": " + day["groups"].join(", ") + "\n";
-                    }
-                }
-
-                const options = {
-                    body: body,
-                    icon: "android-chrome-512x512.png",
-                    badge: "monochrome-96x96.png",
-                    lang: "de",
-                    //timestamp: timestamp,
-                    vibrate: [300, 100, 400],
-                    data: {
-                        type: "subs_update",
-                        plan_id: plan_id,
-                        url: new URL("/" + plan_id + "/?source=Notification", self.location.origin).href,
-                        affected_groups_by_day: affectedGroups,
-                        notification_count: notificationCount,
-                    }
-                };
-
-                self.registration.showNotification(title, options)
-
-                plausible("Notification", {props: {[plan_id]: "Received"}})
-            })
-        );
+        event.waitUntil(showSubsUpdate(data));
     }
 });
 